@@ -0,0 +1,10 @@
+import sys
+from core.hashing import medir_algoritmos
+
+def imprimir_medicion(megabytes=256):
+    resultados = medir_algoritmos(megabytes)
+    for nombre, velocidad in sorted(resultados.items(), key=lambda x: x[1], reverse=True):
+        print(f"{nombre:<10} {velocidad:10.1f} MB/s")
+
+if __name__ == "__main__":
+    imprimir_medicion(int(sys.argv[1]) if len(sys.argv) > 1 else 256)
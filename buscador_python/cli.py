@@ -0,0 +1,147 @@
+import argparse
+import csv
+import json
+import os
+import sys
+from core import duplicados
+from core.archivos import HILOS_RECORRIDO
+from core.hashing import ALGORITMO, ALGORITMOS
+from benchmark import imprimir_medicion
+
+# Búsqueda sin ventana, para cron o servidores sin pantalla: cada duplicado sale por la salida
+# estándar apenas se lo encuentra (NDJSON o CSV), sin esperar al final ni juntar todo en memoria.
+# No importa tkinter ni PIL (ni gui ni core.imagenes)
+FORMATO_NDJSON = "ndjson"
+FORMATO_CSV = "csv"
+COLUMNAS = ["evento", "clave", "ruta", "tamaño", "raiz"]
+
+def crear_parser():
+    parser = argparse.ArgumentParser(description="Busca archivos duplicados (imágenes y videos) sin interfaz gráfica.")
+    parser.add_argument("carpetas", nargs="*", help="carpetas donde buscar; con varias, los duplicados se buscan entre todas")
+    parser.add_argument("-f", "--formato", choices=[FORMATO_NDJSON, FORMATO_CSV], default=FORMATO_NDJSON)
+    parser.add_argument("-o", "--salida", help="archivo de salida (por defecto la salida estándar)")
+    parser.add_argument("-j", "--hilos", type=int, help="hilos de hash (por defecto se autoajusta por disco)")
+    parser.add_argument("--hilos-recorrido", type=int, default=HILOS_RECORRIDO, help="hilos para listar carpetas")
+    parser.add_argument("--cache", help="ruta del caché de hashes (por defecto el global del usuario)")
+    parser.add_argument("--modo", choices=[duplicados.MODO_HASH, duplicados.MODO_COMPARAR], default=duplicados.MODO_HASH,
+                        help="hash: agrupa por hash completo; comparar: compara byte a byte los candidatos")
+    parser.add_argument("--algoritmo", choices=sorted(ALGORITMOS), default=ALGORITMO)
+    parser.add_argument("--backend", choices=[duplicados.BACKEND_HILOS, duplicados.BACKEND_PROCESOS],
+                        default=duplicados.BACKEND_HILOS)
+    parser.add_argument("--max-archivos", type=int,
+                        help=f"tope de archivos (0 = sin tope); por defecto {duplicados.MAX_ARCHIVOS} en memoria "
+                             "y sin tope con --externo")
+    parser.add_argument("--externo", action="store_true",
+                        help="agrupa con ordenamiento externo en disco: sin tope de archivos, memoria acotada")
+    parser.add_argument("--sin-instantanea", action="store_true",
+                        help="vuelve a listar todas las carpetas aunque no hayan cambiado")
+    parser.add_argument("--vigilar", action="store_true",
+                        help="después del escaneo sigue informando los cambios hasta Ctrl+C "
+                             "(el escaneo inicial siempre lista todas las carpetas)")
+    parser.add_argument("--progreso", action="store_true", help="muestra el progreso por la salida de errores")
+    parser.add_argument("--medir", action="store_true", help="mide la velocidad de cada algoritmo de hash y sale")
+    return parser
+
+def _eventos(args):
+    reusar_carpetas = not args.sin_instantanea
+    # El tope por defecto es solo para los modos que guardan el índice en memoria
+    if args.max_archivos is not None:
+        max_archivos = args.max_archivos or None
+    else:
+        max_archivos = None if args.externo else duplicados.MAX_ARCHIVOS
+    if args.vigilar:
+        # Solo acá: el modo vigilancia no hace falta para un escaneo común
+        from core.vigilancia import vigilar_duplicados
+        return vigilar_duplicados(args.carpetas, args.hilos, max_archivos, args.hilos_recorrido,
+                                  args.cache, algoritmo=args.algoritmo, backend=args.backend)
+    if args.externo:
+        return duplicados.iter_duplicados_externo(args.carpetas, args.hilos, max_archivos,
+                                                  args.hilos_recorrido, args.cache, algoritmo=args.algoritmo,
+                                                  reusar_carpetas=reusar_carpetas)
+    return duplicados.iter_duplicados(args.carpetas, args.hilos, max_archivos, modo=args.modo,
+                                      hilos_recorrido=args.hilos_recorrido, cache_path=args.cache,
+                                      backend=args.backend, algoritmo=args.algoritmo,
+                                      reusar_carpetas=reusar_carpetas)
+
+def _fila(evento, archivo, clave):
+    return {"evento": evento, "clave": clave, "ruta": archivo.ruta, "tamaño": archivo.tamaño, "raiz": archivo.raiz}
+
+def _filas(evento):
+    # Cada archivo duplicado sale una sola vez: los dos primeros al formarse el grupo y
+    # después cada uno que se suma
+    if evento.tipo == duplicados.EVENTO_GRUPO_NUEVO:
+        return [_fila("duplicado", archivo, evento.clave) for archivo in evento.grupo]
+    if evento.tipo == duplicados.EVENTO_GRUPO_CRECIO:
+        return [_fila("duplicado", evento.archivo, evento.clave)]
+    if evento.tipo == duplicados.EVENTO_ARCHIVO_QUITADO:
+        return [_fila("quitado", evento.archivo, evento.clave)]
+    if evento.tipo == duplicados.EVENTO_ERROR:
+        return [_fila("error", evento.archivo, None)]
+    return []
+
+def _escritor(formato, salida):
+    if formato == FORMATO_CSV:
+        escritor = csv.DictWriter(salida, COLUMNAS)
+        escritor.writeheader()
+        return escritor.writerow
+    return lambda fila: salida.write(json.dumps(fila, ensure_ascii=False) + "\n")
+
+def _informar(texto, fin="\n"):
+    sys.stderr.write(texto + fin)
+    sys.stderr.flush()
+
+def main(argv=None):
+    parser = crear_parser()
+    args = parser.parse_args(argv)
+    if args.medir:
+        imprimir_medicion()
+        return 0
+    if not args.carpetas:
+        parser.error("falta al menos una carpeta")
+    # Una carpeta mal escrita o un recurso sin montar no tiene que pasar por un escaneo vacío
+    faltan = [carpeta for carpeta in args.carpetas if not os.path.isdir(carpeta)]
+    if faltan:
+        parser.error(f"no existe o no es una carpeta: {', '.join(faltan)}")
+    if args.externo and (args.vigilar or args.modo != duplicados.MODO_HASH or args.backend != duplicados.BACKEND_HILOS):
+        parser.error("--externo solo funciona con --modo hash y el backend de hilos, y sin --vigilar")
+    if args.vigilar and args.modo != duplicados.MODO_HASH:
+        parser.error("--vigilar solo funciona con --modo hash")
+    if args.vigilar and args.sin_instantanea:
+        parser.error("--sin-instantanea no aplica a --vigilar: su escaneo inicial siempre lista todas las carpetas")
+
+    salida = open(args.salida, "w", newline="", encoding="utf-8") if args.salida else sys.stdout
+    escribir = _escritor(args.formato, salida)
+    eventos = _eventos(args)
+    codigo = 0
+    try:
+        for evento in eventos:
+            filas = _filas(evento)
+            for fila in filas:
+                escribir(fila)
+            if filas:
+                salida.flush()
+            if evento.tipo == duplicados.EVENTO_FIN:
+                if args.progreso:
+                    _informar("")
+                _informar(json.dumps(evento.datos, ensure_ascii=False, default=str))
+                if evento.datos.get("error_recorrido"):
+                    codigo = 1
+            elif evento.tipo == duplicados.EVENTO_VIGILANDO:
+                _informar(f"Vigilando cambios ({evento.datos['mecanismo']})")
+            elif args.progreso and evento.tipo in (duplicados.EVENTO_HASHEADO, duplicados.EVENTO_ERROR):
+                _informar(f"\rArchivos procesados: {evento.contador}/{evento.total}", fin="")
+    except KeyboardInterrupt:
+        # Al cerrar el generador se guarda en el caché lo ya hasheado
+        codigo = 130
+    except BrokenPipeError:
+        # Salida cortada (por ejemplo con head): lo que quede pendiente va a /dev/null
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        codigo = 1
+    finally:
+        eventos.close()
+        if args.salida:
+            salida.close()
+    return codigo
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,27 +1,359 @@
 import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import deque, namedtuple
+from queue import Queue, Full
+from stat import S_ISREG
 
 EXT_IMAGENES = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.webp', '.tiff', '.heic')
 EXT_VIDEOS = ('.mp4', '.mkv', '.avi', '.mov', '.wmv', '.flv', '.webm', '.mpeg')
 EXTENSIONES_VALIDAS = EXT_IMAGENES + EXT_VIDEOS
 
-def encontrar_archivos(carpeta, extensiones=EXTENSIONES_VALIDAS, limite=None):
+HILOS_RECORRIDO = 1  # >1 lista varias carpetas a la vez (útil en SMB/NFS)
+LOTE_RAICES = 256  # archivos por lote al juntar el recorrido de varias raíces
+# Una carpeta modificada hace menos de esto no se guarda en la instantánea: otro cambio dentro
+# del mismo tick de mtime del sistema de archivos no se notaría
+MARGEN_INSTANTANEA_NS = 2 * 1000 ** 3
+LOTE_INSTANTANEA = 200
+
+# Datos de stat que viajan con cada archivo para no volver a consultarlos;
+# raiz es el índice de la carpeta de búsqueda de la que salió (ver iterar_raices)
+Archivo = namedtuple("Archivo", ["ruta", "tamaño", "mtime_ns", "inodo", "dispositivo", "enlaces", "raiz"],
+                     defaults=(1, 0))
+
+def esta_dentro(ruta, carpeta):
+    carpeta = os.path.abspath(carpeta)
+    return os.path.commonpath([os.path.abspath(ruta), carpeta]) == carpeta
+
+def crear_registro(entrada, extensiones=EXTENSIONES_VALIDAS):
+    nombre = entrada.name.lower()
+    if not nombre.endswith(extensiones):
+        return None
+    try:
+        if not entrada.is_file():
+            return None
+        stat = entrada.stat()
+        if not stat.st_ino:
+            # En Windows DirEntry no trae inodo ni dispositivo
+            stat = os.stat(entrada.path)
+    except Exception:
+        return None
+    return _registro_desde_stat(entrada.path, nombre, stat)
+
+def registro_de_ruta(ruta, extensiones=EXTENSIONES_VALIDAS):
+    # Como crear_registro, para una ruta suelta (las que informa el modo vigilancia)
+    nombre = os.path.basename(ruta).lower()
+    if not nombre.endswith(extensiones):
+        return None
+    try:
+        stat = os.stat(ruta)
+    except OSError:
+        return None
+    if not S_ISREG(stat.st_mode):
+        return None
+    return _registro_desde_stat(ruta, nombre, stat)
+
+def refrescar_registro(archivo):
+    # El mismo Archivo con el stat de ahora (None si ya no está)
+    try:
+        stat = os.stat(archivo.ruta)
+    except OSError:
+        return None
+    return archivo._replace(tamaño=stat.st_size, mtime_ns=stat.st_mtime_ns, inodo=stat.st_ino,
+                            dispositivo=stat.st_dev, enlaces=stat.st_nlink)
+
+def _registro_desde_stat(ruta, nombre, stat):
+    if nombre.endswith(EXT_VIDEOS):
+        if stat.st_size < 1 * 1024 * 1024:  # Ignorar videos < 1MB
+            return None
+    # Para imágenes no hacemos filtro de tamaño
+
+    return Archivo(ruta, stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_dev, stat.st_nlink)
+
+def _listar(raiz, extensiones):
     archivos = []
-    for raiz, _, nombres in os.walk(carpeta):
-        for nombre in nombres:
-            if nombre.lower().endswith(extensiones):
-                ruta = os.path.join(raiz, nombre)
+    subcarpetas = []
+    try:
+        with os.scandir(raiz) as entradas:
+            for entrada in entradas:
                 try:
-                    tamaño = os.path.getsize(ruta)
+                    if entrada.is_dir(follow_symlinks=False):
+                        subcarpetas.append(entrada.path)
+                        continue
                 except Exception:
                     continue
 
-                ext = nombre.lower()
-                if ext.endswith(EXT_VIDEOS):
-                    if tamaño < 1 * 1024 * 1024:  # Ignorar videos < 1MB
-                        continue
-                # Para imágenes no hacemos filtro de tamaño
+                archivo = crear_registro(entrada, extensiones)
+                if archivo is not None:
+                    archivos.append(archivo)
+    except Exception:
+        pass
+    return archivos, subcarpetas
+
+class InstantaneaDirectorios:
+    # Guarda por carpeta su mtime y lo que devolvió _listar. Agregar, borrar o renombrar una
+    # entrada cambia el mtime de la carpeta, así que si sigue igual se reutiliza el listado sin
+    # scandir ni stat de sus archivos: un re-escaneo hace un stat por carpeta y solo lista las que
+    # cambiaron. Editar un archivo en el lugar no cambia el mtime de su carpeta, así que el tamaño
+    # y el mtime de un listado reutilizado pueden ser viejos: quien los use para algo más que
+    # descartar tamaños únicos tiene que pasarlos por refrescar_registro
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.reutilizadas = 0
+        self.listadas = 0
+        self._lock = threading.Lock()
+        self._nuevas = []
+        self._tocadas = []
+        self._conexion = sqlite3.connect(db_path, check_same_thread=False)
+        self._conexion.execute("PRAGMA journal_mode=WAL")
+        self._conexion.execute("PRAGMA synchronous=NORMAL")
+        self._conexion.execute("""
+            CREATE TABLE IF NOT EXISTS carpetas (
+                ruta TEXT NOT NULL,
+                filtro TEXT NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                archivos BLOB NOT NULL,
+                subcarpetas BLOB NOT NULL,
+                generacion INTEGER NOT NULL,
+                PRIMARY KEY (ruta, filtro)
+            )""")
+        self._conexion.commit()
+        self.generacion = self._conexion.execute("SELECT coalesce(max(generacion), 0) + 1 FROM carpetas").fetchone()[0]
+
+    def listar(self, raiz, extensiones):
+        try:
+            mtime_ns = os.stat(raiz).st_mtime_ns
+        except OSError:
+            return [], []
+        filtro = ",".join(extensiones)
+        with self._lock:
+            fila = self._conexion.execute(
+                "SELECT mtime_ns, archivos, subcarpetas FROM carpetas WHERE ruta = ? AND filtro = ?",
+                (raiz, filtro)).fetchone()
+        if fila and fila[0] == mtime_ns:
+            archivos = [Archivo(os.path.join(raiz, nombre), *datos) for nombre, *datos in pickle.loads(fila[1])]
+            subcarpetas = [os.path.join(raiz, nombre) for nombre in pickle.loads(fila[2])]
+            with self._lock:
+                self.reutilizadas += 1
+                self._tocadas.append((self.generacion, raiz, filtro))
+                self._escribir(LOTE_INSTANTANEA)
+            return archivos, subcarpetas
+
+        archivos, subcarpetas = _listar(raiz, extensiones)
+        with self._lock:
+            self.listadas += 1
+            if mtime_ns < time.time_ns() - MARGEN_INSTANTANEA_NS:
+                datos = [(os.path.basename(a.ruta),) + tuple(a[1:6]) for a in archivos]
+                nombres = [os.path.basename(subcarpeta) for subcarpeta in subcarpetas]
+                self._nuevas.append((raiz, filtro, mtime_ns, pickle.dumps(datos, pickle.HIGHEST_PROTOCOL),
+                                     pickle.dumps(nombres, pickle.HIGHEST_PROTOCOL), self.generacion))
+                self._escribir(LOTE_INSTANTANEA)
+        return archivos, subcarpetas
+
+    def _escribir(self, minimo=1):
+        if len(self._nuevas) + len(self._tocadas) < minimo:
+            return
+        with self._conexion:
+            self._conexion.executemany("INSERT OR REPLACE INTO carpetas VALUES (?, ?, ?, ?, ?, ?)", self._nuevas)
+            self._conexion.executemany("UPDATE carpetas SET generacion = ? WHERE ruta = ? AND filtro = ?", self._tocadas)
+        self._nuevas.clear()
+        self._tocadas.clear()
+
+    def invalidar(self, ruta):
+        # Olvida el listado de la carpeta de `ruta` (un archivo que cambió sin que cambie el mtime
+        # de la carpeta): el próximo escaneo la vuelve a listar
+        with self._lock:
+            self._escribir()
+            with self._conexion:
+                self._conexion.execute("DELETE FROM carpetas WHERE ruta = ?", (os.path.dirname(ruta),))
+
+    def podar(self, carpeta):
+        # Tras un recorrido completo: olvida las carpetas bajo `carpeta` que ya no aparecieron
+        prefijo = os.path.join(carpeta, "")
+        limite = prefijo[:-1] + chr(ord(prefijo[-1]) + 1)
+        with self._lock:
+            self._escribir()
+            with self._conexion:
+                self._conexion.execute(
+                    "DELETE FROM carpetas WHERE ruta >= ? AND ruta < ? AND generacion < ?",
+                    (prefijo, limite, self.generacion))
+
+    def cerrar(self):
+        with self._lock:
+            self._escribir()
+            self._conexion.close()
+
+def _listar_con(instantanea, raiz, extensiones):
+    if instantanea is None:
+        return _listar(raiz, extensiones)
+    return instantanea.listar(raiz, extensiones)
+
+def _iterar_paralelo(carpeta, extensiones, limite, hilos, excluir, instantanea):
+    # Cada hilo procesa primero sus propias carpetas (LIFO, en profundidad) y,
+    # cuando se queda sin trabajo, roba la carpeta más antigua de otro hilo
+    colas = [deque() for _ in range(hilos)]
+    colas[0].append(carpeta)
+    pendientes = [1]  # carpetas encoladas o en proceso
+    hay_trabajo = threading.Condition()
+    detener = threading.Event()
+    salida = Queue(maxsize=hilos * 64)
+
+    def poner(elemento):
+        while not detener.is_set():
+            try:
+                salida.put(elemento, timeout=0.1)
+                return
+            except Full:
+                continue
+
+    def tomar(i):
+        with hay_trabajo:
+            while not detener.is_set() and pendientes[0]:
+                if colas[i]:
+                    return colas[i].pop()
+                for cola in colas:
+                    if cola:
+                        return cola.popleft()
+                hay_trabajo.wait()
+            return None
+
+    def trabajador(i):
+        try:
+            while (raiz := tomar(i)) is not None:
+                archivos, subcarpetas = _listar_con(instantanea, raiz, extensiones)
+                if excluir:
+                    subcarpetas = [subcarpeta for subcarpeta in subcarpetas if subcarpeta not in excluir]
+                if archivos:
+                    poner(archivos)
+                with hay_trabajo:
+                    colas[i].extend(reversed(subcarpetas))
+                    pendientes[0] += len(subcarpetas) - 1
+                    hay_trabajo.notify_all()
+        except Exception as e:
+            # El error (por ejemplo de la instantánea) se relanza en quien consume el recorrido
+            poner(e)
+        poner(None)
+
+    for i in range(hilos):
+        threading.Thread(target=trabajador, args=(i,), daemon=True).start()
+
+    activos = hilos
+    encontrados = 0
+    try:
+        while activos:
+            lote = salida.get()
+            if lote is None:
+                activos -= 1
+                continue
+            if isinstance(lote, Exception):
+                raise lote
+            for archivo in lote:
+                yield archivo
+                encontrados += 1
+                if limite and encontrados >= limite:
+                    return
+    finally:
+        detener.set()
+        with hay_trabajo:
+            hay_trabajo.notify_all()
+
+def iterar_archivos(carpeta, extensiones=EXTENSIONES_VALIDAS, limite=None, hilos=HILOS_RECORRIDO, excluir=(),
+                    instantanea=None):
+    # excluir: subcarpetas (rutas tal como las arma scandir) que no se recorren
+    # instantanea: InstantaneaDirectorios para reutilizar el listado de carpetas sin cambios
+    if hilos > 1:
+        yield from _iterar_paralelo(carpeta, extensiones, limite, hilos, excluir, instantanea)
+        return
+
+    pendientes = [carpeta]
+    encontrados = 0
+    while pendientes:
+        archivos, subcarpetas = _listar_con(instantanea, pendientes.pop(), extensiones)
+        if excluir:
+            subcarpetas = [subcarpeta for subcarpeta in subcarpetas if subcarpeta not in excluir]
+        for archivo in archivos:
+            yield archivo
+            encontrados += 1
+            if limite and encontrados >= limite:
+                return
+        # Orden inverso para recorrer en el mismo orden que os.walk
+        pendientes.extend(reversed(subcarpetas))
+
+def normalizar_raices(raices):
+    # Rutas absolutas, sin repetir la misma carpeta aunque llegue por otro camino (symlink, montaje)
+    unicas = []
+    vistas = set()
+    for raiz in raices:
+        raiz = os.path.abspath(raiz)
+        try:
+            stat = os.stat(raiz)
+        except OSError:
+            continue
+        if (stat.st_dev, stat.st_ino) in vistas:
+            continue
+        vistas.add((stat.st_dev, stat.st_ino))
+        unicas.append(raiz)
+    return unicas
+
+def iterar_raices(raices, extensiones=EXTENSIONES_VALIDAS, limite=None, hilos=HILOS_RECORRIDO, instantanea=None):
+    # Recorre todas las raíces a la vez (un recorrido por raíz) y marca cada archivo con el índice
+    # de su raíz en `raices`. Una raíz anidada en otra se saltea al recorrer la externa, así cada
+    # archivo sale una sola vez, marcado con la raíz más interna
+    if len(raices) == 1:
+        yield from iterar_archivos(raices[0], extensiones, limite, hilos, instantanea=instantanea)
+        return
+
+    detener = threading.Event()
+    salida = Queue(maxsize=len(raices) * 64)
+
+    def poner(elemento):
+        while not detener.is_set():
+            try:
+                salida.put(elemento, timeout=0.1)
+                return
+            except Full:
+                continue
+
+    def recorrer(i, raiz):
+        anidadas = {otra for otra in raices if otra != raiz and esta_dentro(otra, raiz)}
+        lote = []
+        try:
+            for archivo in iterar_archivos(raiz, extensiones, hilos=hilos, excluir=anidadas, instantanea=instantanea):
+                if detener.is_set():
+                    return
+                lote.append(archivo._replace(raiz=i))
+                if len(lote) >= LOTE_RAICES:
+                    poner(lote)
+                    lote = []
+            if lote:
+                poner(lote)
+        except Exception as e:
+            poner(e)
+        finally:
+            poner(None)
+
+    for i, raiz in enumerate(raices):
+        threading.Thread(target=recorrer, args=(i, raiz), daemon=True).start()
+
+    activos = len(raices)
+    encontrados = 0
+    try:
+        while activos:
+            lote = salida.get()
+            if lote is None:
+                activos -= 1
+                continue
+            if isinstance(lote, Exception):
+                raise lote
+            for archivo in lote:
+                yield archivo
+                encontrados += 1
+                if limite and encontrados >= limite:
+                    return
+    finally:
+        detener.set()
 
-                archivos.append(ruta)
-                if limite and len(archivos) >= limite:
-                    return archivos
-    return archivos
+def encontrar_archivos(carpeta, extensiones=EXTENSIONES_VALIDAS, limite=None, hilos=HILOS_RECORRIDO):
+    return list(iterar_archivos(carpeta, extensiones, limite, hilos))
@@ -0,0 +1,339 @@
+import os
+import sqlite3
+import threading
+import time
+
+LOTE_ESCRITURA = 500
+INTERVALO_GUARDADO = 30.0  # segundos como máximo que un hash calculado espera en memoria antes de escribirse
+VERSION_ESQUEMA = 4
+
+# Mantenimiento: al pasar un límite se borran las entradas vistas hace más tiempo (LRU)
+# hasta quedar en FRACCION_RECORTE del límite, para no recortar en cada escaneo
+MAX_ENTRADAS_CACHE = 2000000
+MAX_MB_CACHE = 512
+DIAS_SIN_VER = 365          # entradas de carpetas que no se escanean hace un año se olvidan
+FRACCION_RECORTE = 0.9
+FRACCION_LIBRE_COMPACTAR = 0.25  # compactar cuando más de esta parte del archivo son páginas libres
+# Segundos que se espera a otro proceso que tiene la base bloqueada (por ejemplo compactándola)
+# antes de dar error; el valor por defecto de sqlite3 (5 s) es corto para un VACUUM grande
+ESPERA_BLOQUEO = 120.0
+
+COLUMNAS = ("ruta", "parcial", "hash")
+
+def ruta_cache_global():
+    # Un único caché por usuario, compartido por todas las carpetas escaneadas
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    carpeta = os.path.join(base, "buscador_python")
+    os.makedirs(carpeta, exist_ok=True)
+    return os.path.join(carpeta, "hashes.sqlite")
+
+def ruta_instantanea(cache_path=None):
+    # La instantánea de carpetas vive al lado del caché de hashes
+    if cache_path == ":memory:":
+        return ":memory:"
+    if cache_path:
+        return cache_path + ".carpetas"
+    return os.path.join(os.path.dirname(ruta_cache_global()), "carpetas.sqlite")
+
+def clave_archivo(archivo):
+    # El contenido se identifica por inodo + tamaño + mtime; la ruta es solo informativa,
+    # así renombrar, mover o escanear carpetas solapadas reutiliza el hash
+    return (archivo.dispositivo, archivo.inodo, archivo.tamaño, archivo.mtime_ns)
+
+class CacheHashes:
+    def __init__(self, db_path, algoritmo="md5"):
+        self.db_path = db_path
+        self.algoritmo = algoritmo
+        self._lock = threading.Lock()
+        self._pendientes = {}
+        self._vistos = []
+        self._ultimo_guardado = time.monotonic()
+        self.consultas = 0
+        self.aciertos = 0
+        self._conexion = sqlite3.connect(db_path, timeout=ESPERA_BLOQUEO, check_same_thread=False)
+        # Solo tiene efecto en un archivo nuevo; en uno existente lo aplica el primer VACUUM de compactar()
+        self._conexion.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self._conexion.execute("PRAGMA journal_mode=WAL")
+        self._conexion.execute("PRAGMA synchronous=NORMAL")
+        version = self._conexion.execute("PRAGMA user_version").fetchone()[0]
+        if version == 3:
+            self._conexion.execute("ALTER TABLE hashes ADD COLUMN visto INTEGER NOT NULL DEFAULT 0")
+        elif version == 2:
+            # La versión 2 solo tenía digests MD5: se conservan con ese nombre de algoritmo
+            self._conexion.execute("DROP INDEX IF EXISTS idx_hashes_ruta")
+            self._conexion.execute("ALTER TABLE hashes RENAME TO hashes_v2")
+            self._crear_tablas()
+            self._conexion.execute("""
+                INSERT INTO hashes (dispositivo, inodo, size, mtime_ns, algoritmo, ruta, parcial, hash)
+                SELECT dispositivo, inodo, size, mtime_ns, 'md5', ruta, parcial, hash FROM hashes_v2""")
+            self._conexion.execute("DROP TABLE hashes_v2")
+        elif version != VERSION_ESQUEMA:
+            self._conexion.execute("DROP TABLE IF EXISTS hashes")
+        if version in (2, 3):
+            # Las entradas migradas no tienen fecha de último visto: cuentan como vistas ahora,
+            # si no el primer recorte las tomaría como viejas y las borraría todas
+            self._conexion.execute("UPDATE hashes SET visto = CAST(strftime('%s', 'now') AS INTEGER)")
+        self._conexion.execute(f"PRAGMA user_version = {VERSION_ESQUEMA}")
+        self._crear_tablas()
+        self._conexion.execute("""
+            CREATE TABLE IF NOT EXISTS ajustes (
+                dispositivo INTEGER PRIMARY KEY,
+                hilos INTEGER NOT NULL,
+                mb_por_segundo REAL
+            )""")
+        # Un registro por conjunto de raíces: si un escaneo se corta queda sin terminar
+        self._conexion.execute("""
+            CREATE TABLE IF NOT EXISTS escaneos (
+                raices TEXT PRIMARY KEY,
+                inicio REAL NOT NULL,
+                actualizado REAL NOT NULL,
+                terminado INTEGER NOT NULL DEFAULT 0,
+                archivos INTEGER NOT NULL DEFAULT 0,
+                hasheados INTEGER NOT NULL DEFAULT 0
+            )""")
+        self._conexion.commit()
+
+    def _crear_tablas(self):
+        self._conexion.execute("""
+            CREATE TABLE IF NOT EXISTS hashes (
+                dispositivo INTEGER NOT NULL,
+                inodo INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                algoritmo TEXT NOT NULL,
+                ruta TEXT,
+                parcial TEXT,
+                hash TEXT,
+                visto INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (dispositivo, inodo, size, mtime_ns, algoritmo)
+            )""")
+        self._conexion.execute("CREATE INDEX IF NOT EXISTS idx_hashes_ruta ON hashes (ruta)")
+        self._conexion.execute("CREATE INDEX IF NOT EXISTS idx_hashes_visto ON hashes (visto)")
+
+    def get(self, archivo, default=None):
+        # Carga perezosa: solo se consulta la fila del archivo que se está procesando
+        clave = clave_archivo(archivo)
+        with self._lock:
+            pendiente = self._pendientes.get(clave)
+            fila = self._conexion.execute(
+                "SELECT ruta, parcial, hash FROM hashes"
+                " WHERE dispositivo = ? AND inodo = ? AND size = ? AND mtime_ns = ? AND algoritmo = ?",
+                clave + (self.algoritmo,)
+            ).fetchone()
+        entrada = {columna: valor for columna, valor in zip(COLUMNAS, fila or ()) if valor is not None}
+        entrada.update(pendiente or {})
+        return entrada or default
+
+    def buscar(self, archivo, columna):
+        # Como get(archivo).get(columna), contando aciertos para la tasa de estadisticas()
+        valor = self.get(archivo, {}).get(columna)
+        with self._lock:
+            self.consultas += 1
+            self.aciertos += valor is not None
+        return valor
+
+    def __contains__(self, archivo):
+        return self.get(archivo) is not None
+
+    def registrar(self, archivo, entrada):
+        with self._lock:
+            pendiente = self._pendientes.setdefault(clave_archivo(archivo), {})
+            pendiente.update(entrada, ruta=archivo.ruta)
+            if (len(self._pendientes) >= LOTE_ESCRITURA
+                    or time.monotonic() - self._ultimo_guardado >= INTERVALO_GUARDADO):
+                self._escribir_pendientes()
+
+    def vaciar(self):
+        with self._lock:
+            self._escribir_pendientes()
+
+    def _escribir_pendientes(self):
+        # Cada lote es una transacción: con WAL, un corte deja el caché como estaba
+        # después del último lote confirmado, nunca a medio escribir
+        self._ultimo_guardado = time.monotonic()
+        if not self._pendientes:
+            return
+        ahora = int(time.time())
+        filas = [
+            clave + (self.algoritmo, e.get("ruta"), e.get("parcial"), e.get("hash"), ahora)
+            for clave, e in self._pendientes.items()
+        ]
+        with self._conexion:
+            self._conexion.executemany("""
+                INSERT INTO hashes (dispositivo, inodo, size, mtime_ns, algoritmo, ruta, parcial, hash, visto)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (dispositivo, inodo, size, mtime_ns, algoritmo) DO UPDATE SET
+                    visto = excluded.visto,
+                    ruta = excluded.ruta,
+                    parcial = coalesce(excluded.parcial, parcial),
+                    hash = coalesce(excluded.hash, hash)""", filas)
+        self._pendientes.clear()
+
+    def iniciar_recorrido(self):
+        with self._lock:
+            self._vistos = []
+            self._conexion.execute("""
+                CREATE TEMP TABLE IF NOT EXISTS vistos (
+                    dispositivo INTEGER, inodo INTEGER, size INTEGER, mtime_ns INTEGER,
+                    PRIMARY KEY (dispositivo, inodo, size, mtime_ns))""")
+            self._conexion.execute("DELETE FROM vistos")
+
+    def marcar_visto(self, archivo):
+        # Los archivos del recorrido van a una tabla temporal por lotes, no a memoria
+        with self._lock:
+            self._vistos.append(clave_archivo(archivo))
+            if len(self._vistos) >= LOTE_ESCRITURA:
+                self._escribir_vistos()
+
+    def _escribir_vistos(self):
+        if not self._vistos:
+            return
+        # Además de la tabla temporal para podar, la fecha de último visto alimenta el recorte LRU;
+        # se actualiza como mucho una vez por hora para no reescribir el índice en cada escaneo
+        ahora = int(time.time())
+        with self._conexion:
+            self._conexion.executemany("INSERT OR IGNORE INTO vistos VALUES (?, ?, ?, ?)", self._vistos)
+            self._conexion.executemany("""
+                UPDATE hashes SET visto = ?
+                WHERE dispositivo = ? AND inodo = ? AND size = ? AND mtime_ns = ? AND visto < ?""",
+                [(ahora,) + clave + (ahora - 3600,) for clave in self._vistos])
+        self._vistos.clear()
+
+    def podar(self, carpetas):
+        # Borra de una vez las entradas registradas bajo `carpetas` (una o varias raíces del mismo
+        # recorrido) cuyo archivo ya no está (o cambió de tamaño/mtime) en el recorrido actual.
+        # La tabla de vistos se vacía recién después de podar todas
+        if isinstance(carpetas, str):
+            carpetas = [carpetas]
+        borradas = 0
+        with self._lock:
+            self._escribir_pendientes()
+            self._escribir_vistos()
+            with self._conexion:
+                for carpeta in carpetas:
+                    prefijo = os.path.join(carpeta, "")
+                    limite = prefijo[:-1] + chr(ord(prefijo[-1]) + 1)
+                    cursor = self._conexion.execute("""
+                        DELETE FROM hashes WHERE ruta >= ? AND ruta < ?
+                        AND (dispositivo, inodo, size, mtime_ns) NOT IN (SELECT * FROM vistos)""", (prefijo, limite))
+                    borradas += cursor.rowcount
+                self._conexion.execute("DELETE FROM vistos")
+            return borradas
+
+    def iniciar_escaneo(self, raices):
+        # Devuelve el progreso del escaneo anterior de las mismas raíces si quedó sin terminar
+        clave = "\n".join(raices)
+        ahora = time.time()
+        with self._lock, self._conexion:
+            fila = self._conexion.execute(
+                "SELECT inicio, actualizado, archivos, hasheados FROM escaneos WHERE raices = ? AND NOT terminado",
+                (clave,)).fetchone()
+            self._conexion.execute("""
+                INSERT INTO escaneos (raices, inicio, actualizado) VALUES (?, ?, ?)
+                ON CONFLICT (raices) DO UPDATE SET
+                    inicio = excluded.inicio, actualizado = excluded.actualizado,
+                    terminado = 0, archivos = 0, hasheados = 0""", (clave, ahora, ahora))
+        if fila is None:
+            return None
+        return dict(zip(("inicio", "actualizado", "archivos", "hasheados"), fila))
+
+    def punto_de_control(self, raices, archivos, hasheados):
+        # Escribe lo pendiente y deja constancia de hasta dónde llegó el escaneo
+        with self._lock:
+            self._escribir_pendientes()
+            with self._conexion:
+                self._conexion.execute(
+                    "UPDATE escaneos SET actualizado = ?, archivos = ?, hasheados = ? WHERE raices = ?",
+                    (time.time(), archivos, hasheados, "\n".join(raices)))
+
+    def terminar_escaneo(self, raices):
+        with self._lock, self._conexion:
+            self._conexion.execute(
+                "UPDATE escaneos SET actualizado = ?, terminado = 1 WHERE raices = ?", (time.time(), "\n".join(raices)))
+
+    def bytes_en_disco(self):
+        if self.db_path == ":memory:":
+            return 0
+        return sum(os.path.getsize(self.db_path + sufijo) for sufijo in ("", "-wal")
+                   if os.path.exists(self.db_path + sufijo))
+
+    def estadisticas(self):
+        with self._lock:
+            entradas = self._conexion.execute("SELECT count(*) FROM hashes").fetchone()[0]
+            consultas, aciertos = self.consultas, self.aciertos
+        return {
+            "entradas": entradas,
+            "bytes_en_disco": self.bytes_en_disco(),
+            "consultas": consultas,
+            "aciertos": aciertos,
+            "tasa_aciertos": round(aciertos / consultas, 3) if consultas else 0.0,
+        }
+
+    def recortar(self, max_entradas=MAX_ENTRADAS_CACHE, max_mb=MAX_MB_CACHE, dias_sin_ver=DIAS_SIN_VER):
+        # Borra lo no visto en dias_sin_ver y, si sigue sobre algún límite, las entradas vistas
+        # hace más tiempo. Devuelve cuántas se borraron
+        with self._lock:
+            self._escribir_pendientes()
+            self._escribir_vistos()
+            borradas = 0
+            with self._conexion:
+                if dias_sin_ver:
+                    limite = int(time.time()) - dias_sin_ver * 86400
+                    borradas += self._conexion.execute("DELETE FROM hashes WHERE visto < ?", (limite,)).rowcount
+                entradas = self._conexion.execute("SELECT count(*) FROM hashes").fetchone()[0]
+                maximo = max_entradas or entradas
+                if max_mb and entradas:
+                    # Con las páginas libres descontadas, el tamaño medio por entrada da el máximo en bytes
+                    paginas, libres, tamaño_pagina = (self._conexion.execute(f"PRAGMA {nombre}").fetchone()[0]
+                                                      for nombre in ("page_count", "freelist_count", "page_size"))
+                    por_entrada = (paginas - libres) * tamaño_pagina / entradas
+                    maximo = min(maximo, int(max_mb * 1024 * 1024 / por_entrada))
+                if entradas > maximo:
+                    sobran = entradas - int(maximo * FRACCION_RECORTE)
+                    borradas += self._conexion.execute(
+                        "DELETE FROM hashes WHERE rowid IN (SELECT rowid FROM hashes ORDER BY visto LIMIT ?)",
+                        (sobran,)).rowcount
+            return borradas
+
+    def necesita_compactar(self):
+        with self._lock:
+            paginas = self._conexion.execute("PRAGMA page_count").fetchone()[0]
+            libres = self._conexion.execute("PRAGMA freelist_count").fetchone()[0]
+        return paginas and libres / paginas > FRACCION_LIBRE_COMPACTAR
+
+    def compactar(self):
+        # Con una conexión aparte: VACUUM falla si esta tiene una transacción abierta
+        if self.db_path == ":memory:":
+            return
+        conexion = sqlite3.connect(self.db_path, timeout=ESPERA_BLOQUEO)
+        try:
+            if conexion.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+                # Con execute() sqlite3 avanza un solo paso (una página); executescript lo corre completo
+                conexion.executescript("PRAGMA incremental_vacuum;")
+            else:
+                conexion.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                conexion.execute("VACUUM")
+            conexion.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            conexion.close()
+
+    def hilos_preferidos(self, dispositivo):
+        with self._lock:
+            fila = self._conexion.execute("SELECT hilos FROM ajustes WHERE dispositivo = ?", (dispositivo,)).fetchone()
+        return fila[0] if fila else None
+
+    def guardar_hilos(self, dispositivo, hilos, mb_por_segundo):
+        with self._lock, self._conexion:
+            self._conexion.execute("""
+                INSERT INTO ajustes (dispositivo, hilos, mb_por_segundo) VALUES (?, ?, ?)
+                ON CONFLICT (dispositivo) DO UPDATE SET
+                    hilos = excluded.hilos, mb_por_segundo = excluded.mb_por_segundo""",
+                (dispositivo, hilos, mb_por_segundo))
+
+    def cerrar(self):
+        with self._lock:
+            self._escribir_pendientes()
+            self._conexion.close()
@@ -0,0 +1,71 @@
+import threading
+import time
+
+HILOS_MAXIMOS = 16
+INTERVALO_AJUSTE = 2.0  # segundos entre mediciones
+MEJORA_MINIMA = 0.05  # 5% más de bytes/s para seguir en la misma dirección
+CAMBIOS_PARA_ESTABILIZAR = 4
+
+class LimiteConcurrencia:
+    # Como un semáforo, pero el límite puede cambiar mientras los hilos trabajan
+    def __init__(self, limite):
+        self.limite = limite
+        self.activos = 0
+        self._condicion = threading.Condition()
+
+    def entrar(self):
+        with self._condicion:
+            while self.activos >= self.limite:
+                self._condicion.wait()
+            self.activos += 1
+
+    def salir(self):
+        with self._condicion:
+            self.activos -= 1
+            self._condicion.notify()
+
+    def ajustar(self, limite):
+        with self._condicion:
+            self.limite = limite
+            self._condicion.notify_all()
+
+class Autoajuste:
+    # Sube o baja de a un hilo según mejoren los bytes/s; cuando cambió de dirección
+    # varias veces se queda con el mejor valor medido
+    def __init__(self, limite, minimo=1, maximo=HILOS_MAXIMOS, intervalo=INTERVALO_AJUSTE):
+        self.limite = limite
+        self.minimo = minimo
+        self.maximo = maximo
+        self.intervalo = intervalo
+        self.direccion = 1
+        self.anterior = None
+        self.cambios = 0
+        self.mejor = (limite.limite, 0.0)
+        self._ultima_medicion = (time.monotonic(), 0)
+
+    @property
+    def estable(self):
+        return self.cambios >= CAMBIOS_PARA_ESTABILIZAR
+
+    def revisar(self, bytes_leidos):
+        ahora = time.monotonic()
+        momento, bytes_antes = self._ultima_medicion
+        if self.estable or ahora - momento < self.intervalo:
+            return
+        self._ultima_medicion = (ahora, bytes_leidos)
+        if bytes_leidos == bytes_antes:
+            return  # solo hubo aciertos de caché: no hay nada que medir
+
+        velocidad = (bytes_leidos - bytes_antes) / (ahora - momento)
+        hilos = self.limite.limite
+        if velocidad > self.mejor[1]:
+            self.mejor = (hilos, velocidad)
+        if self.anterior is not None and velocidad < self.anterior * (1 + MEJORA_MINIMA):
+            self.direccion = -self.direccion
+            self.cambios += 1
+        self.anterior = velocidad
+
+        if self.estable:
+            self.limite.ajustar(self.mejor[0])
+        else:
+            self.limite.ajustar(max(self.minimo, min(self.maximo, hilos + self.direccion)))
@@ -0,0 +1,54 @@
+import heapq
+import pickle
+import tempfile
+
+REGISTROS_POR_CORRIDA = 200000  # registros en memoria antes de volcar una corrida ordenada a disco
+REGISTROS_POR_BLOQUE = 1024     # registros por pickle dentro de una corrida
+
+class CorridasOrdenadas:
+    # Ordenamiento externo: los registros (tuplas comparables) se juntan en memoria, se ordenan
+    # y se vuelcan a un archivo temporal al llegar a max_registros. Al recorrerlas las corridas
+    # se fusionan con heapq.merge, así la memoria queda acotada a max_registros más un bloque
+    # por corrida, sin importar cuántos registros haya en total
+    def __init__(self, directorio=None, max_registros=REGISTROS_POR_CORRIDA):
+        self.directorio = directorio
+        self.max_registros = max_registros
+        self.cantidad = 0
+        self.volcadas = 0
+        self._registros = []
+        self._corridas = []
+
+    def agregar(self, registro):
+        self._registros.append(registro)
+        self.cantidad += 1
+        if len(self._registros) >= self.max_registros:
+            self._volcar()
+
+    def _volcar(self):
+        self._registros.sort()
+        f = tempfile.TemporaryFile(dir=self.directorio)
+        for inicio in range(0, len(self._registros), REGISTROS_POR_BLOQUE):
+            pickle.dump(self._registros[inicio:inicio + REGISTROS_POR_BLOQUE], f, pickle.HIGHEST_PROTOCOL)
+        self._corridas.append(f)
+        self.volcadas += 1
+        self._registros = []
+
+    def _leer(self, f):
+        f.seek(0)
+        while True:
+            try:
+                bloque = pickle.load(f)
+            except EOFError:
+                return
+            yield from bloque
+
+    def __iter__(self):
+        # Lo que no llegó a volcarse se fusiona desde memoria; si todo entró, no se toca el disco
+        self._registros.sort()
+        return heapq.merge(self._registros, *[self._leer(f) for f in self._corridas])
+
+    def cerrar(self):
+        for f in self._corridas:
+            f.close()
+        self._corridas = []
+        self._registros = []
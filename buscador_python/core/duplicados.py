@@ -1,68 +1,835 @@
-import os
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from queue import Queue
-from core.hashing import hash_parcial, cargar_cache, guardar_cache
-from core.archivos import EXT_IMAGENES, EXT_VIDEOS, EXTENSIONES_VALIDAS, encontrar_archivos
+import threading
+from collections import deque, namedtuple
+from itertools import groupby
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from queue import Queue, Empty, Full
+from core.hashing import (ALGORITMO, ALGORITMOS, MAX_BYTES, TAMAÑO_BLOQUE, LIBERAR_CACHE, aconsejar, hash_parcial, hash_completo, hashear_lote, muestra_es_completa,
+                          cargar_cache, guardar_cache, mantener_cache)
+from core.cache import INTERVALO_GUARDADO, ruta_instantanea
+from core.concurrencia import HILOS_MAXIMOS
+from core.planificador import PlanificadorDispositivos
+from core.archivos import (EXT_IMAGENES, EXT_VIDEOS, EXTENSIONES_VALIDAS, HILOS_RECORRIDO, Archivo,
+                           InstantaneaDirectorios, esta_dentro, iterar_archivos, iterar_raices, normalizar_raices,
+                           refrescar_registro)
+from core.corridas import REGISTROS_POR_CORRIDA, CorridasOrdenadas
+from core.resultados import AlmacenResultados
 
-MAX_HILOS = 4
-MAX_ARCHIVOS = 300000
+MAX_HILOS = 4  # punto de partida del autoajuste cuando no hay un valor guardado
+MAX_ARCHIVOS = 300000  # tope del modo en memoria; iter_duplicados_externo no tiene tope
 
-def escanear_y_hash(carpeta, progress_callback=None, max_hilos=MAX_HILOS, max_archivos=MAX_ARCHIVOS):
-    archivos = encontrar_archivos(carpeta, EXTENSIONES_VALIDAS, limite=max_archivos)
-    hashes = {}
-    errores = []
+MODO_HASH = "hash"
+MODO_COMPARAR = "comparar"
+BLOQUE_COMPARACION = 256 * 1024
+MAX_ABIERTOS = 32  # grupos más grandes se resuelven por hash para no agotar descriptores
+VENTANA_POR_HILO = 8
 
-    cache_path = os.path.join(carpeta, ".duplicados_cache.json")
-    cache = cargar_cache(cache_path)
+# Con muchos archivos chicos el GIL limita a los hilos; el backend de procesos hashea
+# lotes de rutas en otros procesos y solo devuelve (índice, digest)
+BACKEND_HILOS = "hilos"
+BACKEND_PROCESOS = "procesos"
+TAMAÑO_LOTE = 64
+INTERVALO_ETAPAS = 5.0  # segundos entre reportes de rendimiento por etapa
 
-    resultado_queue = Queue()
-    nuevo_cache = {}
-    contador = 0
-    total = len(archivos)
+EVENTO_HASHEADO = "hasheado"          # archivo leído; clave indica su grupo si ya es definitivo
+EVENTO_ERROR = "error"                # no se pudo leer archivo
+EVENTO_GRUPO_NUEVO = "grupo_nuevo"    # clave tiene por primera vez dos archivos iguales
+EVENTO_GRUPO_CRECIO = "grupo_crecio"  # archivo se sumó al grupo clave
+EVENTO_ETAPAS = "etapas"              # datos trae el rendimiento de cada etapa hasta ahora
+EVENTO_FIN = "fin"                    # datos trae las estadísticas del escaneo
+# Solo en el modo vigilancia (ver core.vigilancia)
+EVENTO_VIGILANDO = "vigilando"              # terminó el escaneo inicial; datos trae el mecanismo usado
+EVENTO_ARCHIVO_QUITADO = "archivo_quitado"  # archivo salió del grupo clave; grupo trae los que quedan
+
+Evento = namedtuple("Evento", ["tipo", "archivo", "clave", "grupo", "contador", "total", "datos"],
+                    defaults=(None, None, None, 0, 0, None))
+
+def nuevos_candidatos(indice, clave, archivo):
+    # Solo guarda el primer archivo de cada clave: al llegar el segundo salen los dos,
+    # y a partir de ahí cada archivo nuevo sale directamente
+    primero = indice.get(clave, False)
+    if primero is False:
+        indice[clave] = archivo
+        return []
+    indice[clave] = None
+    return [archivo] if primero is None else [primero, archivo]
+
+def _nueva_etapa():
+    return {"elementos": 0, "bytes": 0, "inicio": None, "fin": None}
+
+def resumen_etapas(etapas):
+    resumen = {}
+    ahora = time.monotonic()
+    for nombre, etapa in etapas.items():
+        segundos = ((etapa["fin"] or ahora) - etapa["inicio"]) if etapa["inicio"] else 0.0
+        resumen[nombre] = {
+            "elementos": etapa["elementos"],
+            "segundos": round(segundos, 3),
+            "por_segundo": round(etapa["elementos"] / segundos, 1) if segundos else 0.0,
+        }
+        if etapa["bytes"]:
+            resumen[nombre]["mb_por_segundo"] = round(etapa["bytes"] / segundos / (1024 * 1024), 1) if segundos else 0.0
+    return resumen
 
-    def trabajador(path):
+def _poner(cola, elemento, detener):
+    while not detener.is_set():
         try:
-            stat = os.stat(path)
-            size = stat.st_size
-            mtime = stat.st_mtime
-
-            if path in cache:
-                cache_entry = cache[path]
-                if cache_entry["size"] == size and cache_entry["mtime"] == mtime:
-                    hash_valor = cache_entry["hash"]
-                else:
-                    hash_valor = hash_parcial(path)
-            else:
-                hash_valor = hash_parcial(path)
+            cola.put(elemento, timeout=0.1)
+            return True
+        except Full:
+            continue
+    return False
+
+def iter_duplicados(carpeta, max_hilos=None, max_archivos=MAX_ARCHIVOS, solo_candidatos=True,
+                    modo=MODO_HASH, hilos_recorrido=HILOS_RECORRIDO, cache_path=None, ventana=None,
+                    backend=BACKEND_HILOS, tamaño_lote=TAMAÑO_LOTE, orden_fisico=False, tamaño_bloque=TAMAÑO_BLOQUE,
+                    algoritmo=ALGORITMO, reusar_carpetas=True, al_recorrer=None, almacen=None):
+    # Etapas concurrentes unidas por colas acotadas:
+    #   recorrido -> tamaño (agrupar por st_size) -> hash (pool) -> agrupar (este generador)
+    # Como mucho `ventana` archivos esperan o se están hasheando en la etapa 1, así que
+    # la memoria no crece con el tamaño del árbol y el recorrido se frena si el hash no da abasto
+    # El hash se reparte por dispositivo, cada uno con su cola ordenada por inodo y sus hilos.
+    # Sin max_hilos, la cantidad de hilos de cada dispositivo se ajusta midiendo bytes/s y se
+    # recuerda en el caché, así el siguiente escaneo arranca cerca del mejor valor.
+    # carpeta puede ser una lista de raíces: se recorren a la vez hacia el mismo índice y cada
+    # archivo trae en .raiz el índice de la suya (en estadisticas["raices"]).
+    # Con reusar_carpetas, las carpetas cuyo mtime no cambió desde el último escaneo no se vuelven
+    # a listar (ver InstantaneaDirectorios).
+    # al_recorrer(archivo) se llama desde otro hilo con cada archivo del recorrido, también con los
+    # que no generan eventos (tamaño único, enlaces duros repetidos)
+    # Los archivos con clave se guardan en un AlmacenResultados compacto (almacen, o uno propio):
+    # quien los necesita todos, como escanear_y_hash, pasa el suyo en lugar de copiarlos de los eventos
+    raices = [carpeta] if isinstance(carpeta, str) else normalizar_raices(carpeta)
+    if algoritmo not in ALGORITMOS:
+        raise ValueError(f"Algoritmo de hash desconocido: {algoritmo}")
+    cache = cargar_cache(cache_path, algoritmo)
+    instantanea = _abrir_instantanea(cache_path) if reusar_carpetas else None
+    hilos_hash = max_hilos or HILOS_MAXIMOS
 
+    if backend == BACKEND_PROCESOS:
+        # Cada proceso necesita lotes completos esperando para no quedarse sin trabajo
+        ventana = ventana or hilos_hash * tamaño_lote * 2
+        pool = ProcessPoolExecutor(max_workers=hilos_hash)
+    else:
+        ventana = ventana or hilos_hash * VENTANA_POR_HILO
+        pool = None
+    cache.iniciar_recorrido()
+    # Si el escaneo anterior de estas raíces se cortó, sus hashes ya están en el caché (se guardan
+    # cada INTERVALO_GUARDADO segundos como máximo): este escaneo solo lee lo que faltó
+    previo = cache.iniciar_escaneo(raices)
+
+    detener = threading.Event()
+    cola_recorrido = Queue(maxsize=ventana)
+    cola_resultados = Queue()
+    lugares = threading.Semaphore(ventana)
+    lock_estado = threading.Lock()
+
+    etapas = {nombre: _nueva_etapa() for nombre in ("recorrido", "tamaño", "hash", "agrupar")}
+    por_tamaño = {}
+    colisiones = {}
+    por_comparar = {}
+    grupos = AlmacenResultados() if almacen is None else almacen
+    enlazados = set()
+    estadisticas = {"total": 0, "candidatos": 0, "hash_completo": 0, "comparados": 0, "enlaces_omitidos": 0,
+                    "reutilizados": 0, "reanudado": previo is not None}
+    contador = 0
+    total = 0
+    enviadas = 0
+    recibidas = 0
+    fin_tamaño = threading.Event()
+
+    def sumar_bytes(dispositivo, n):
+        with lock_estado:
+            etapas["hash"]["bytes"] += n
+        planificador.sumar_bytes(dispositivo, n)
+
+    def hashear(etapa, archivo):
+        valor, leidos = hashear_con_cache(cache, archivo, "hash" if etapa == "completo" else "parcial",
+                                          tamaño_bloque, algoritmo)
+        if leidos:
+            sumar_bytes(archivo.dispositivo, leidos)
+        return etapa, valor, archivo
+
+    # Etapa 1: huella barata con el inicio y el final de cada archivo
+    def trabajador_parcial(archivo):
+        return hashear("parcial", archivo)
+
+    # Etapa 2: hash completo solo para los que siguen colisionando
+    def trabajador_completo(archivo):
+        return hashear("completo", archivo)
+
+    # Backend de procesos: el caché se consulta aquí y solo los que faltan viajan al pool
+    def trabajador_lote(etapa, archivos):
+        clave = "hash" if etapa == "completo" else "parcial"
+        resultados = []
+        faltan = []
+        for archivo in archivos:
+            hash_valor = cache.buscar(archivo, clave)
             if hash_valor:
-                nuevo_cache[path] = {"size": size, "mtime": mtime, "hash": hash_valor}
-            resultado_queue.put((hash_valor, path))
-        except Exception:
-            resultado_queue.put((None, path))
-
-    with ThreadPoolExecutor(max_workers=max_hilos) as executor:
-        futures = [executor.submit(trabajador, path) for path in archivos]
-        for future in as_completed(futures):
-            pass
-
-    # Procesar resultados
-    while not resultado_queue.empty():
-        hash_valor, path = resultado_queue.get()
-        if hash_valor:
-            hashes.setdefault(hash_valor, []).append(path)
+                resultados.append((etapa, hash_valor, archivo))
+            else:
+                faltan.append(archivo)
+        if faltan:
+            rutas = [archivo.ruta for archivo in faltan]
+            indices, digests, tamaño = pool.submit(
+                hashear_lote, rutas, etapa == "completo", tamaño_bloque=tamaño_bloque, algoritmo=algoritmo).result()
+            calculados = {i: digests[n * tamaño:(n + 1) * tamaño].hex() for n, i in enumerate(indices)}
+            for i, archivo in enumerate(faltan):
+                hash_valor = calculados.get(i)
+                sumar_bytes(archivo.dispositivo, _bytes_a_leer(archivo, clave))
+                if hash_valor:
+                    _registrar_hash(cache, archivo, clave, hash_valor)
+                resultados.append((etapa, hash_valor, archivo))
+        return resultados
+
+    # Modo comparar: los grupos no tienen digest, se identifican por tamaño y huella parcial
+    def trabajador_comparar(clave, grupo):
+        stats_grupo = {}
+        iguales, fallidos = comparar_grupo([archivo.ruta for archivo in grupo], MAX_BYTES, estadisticas=stats_grupo)
+        sumar_bytes(grupo[0].dispositivo, stats_grupo["bytes_leidos"])
+        return "comparado", (clave, iguales, fallidos), grupo
+
+    # Prioridad 0: etapa 2 y comparaciones (ya hay duplicados probables), 1: etapa 1
+    def enviar(prioridad, trabajador, *args, archivos=1):
+        nonlocal enviadas, total
+        with lock_estado:
+            enviadas += 1
+            total += archivos
+        archivo = args[-1][0] if isinstance(args[-1], list) else args[0]
+        planificador.enviar(archivo, prioridad, trabajador, args)
+
+    def etapa_recorrido():
+        etapa = etapas["recorrido"]
+        etapa["inicio"] = time.monotonic()
+        try:
+            for archivo in iterar_raices(raices, EXTENSIONES_VALIDAS, limite=max_archivos, hilos=hilos_recorrido,
+                                         instantanea=instantanea):
+                etapa["elementos"] += 1
+                if not _poner(cola_recorrido, archivo, detener):
+                    return
+        except Exception as e:
+            # El escaneo sigue con lo recorrido, pero no cuenta como completo (ver el final)
+            print(f"Error al recorrer carpetas: {e}")
+            estadisticas["error_recorrido"] = str(e)
+        finally:
+            etapa["fin"] = time.monotonic()
+            _poner(cola_recorrido, None, detener)
+
+    # Un archivo con tamaño único no puede tener duplicados: solo se lee cuando aparece otro igual
+    def etapa_tamaño():
+        etapa = etapas["tamaño"]
+        etapa["inicio"] = time.monotonic()
+        try:
+            while not detener.is_set():
+                try:
+                    archivo = cola_recorrido.get(timeout=0.1)
+                except Empty:
+                    continue
+                if archivo is None:
+                    return
+                etapa["elementos"] += 1
+                estadisticas["total"] += 1
+                cache.marcar_visto(archivo)
+                if al_recorrer:
+                    al_recorrer(archivo)
+                # Enlaces duros al mismo inodo son un solo archivo en disco: se hashea una sola vez
+                # y no se informan como duplicados (borrarlos no libera espacio). Lo mismo un symlink
+                # (el recorrido lo sigue y trae el inodo del destino, con st_nlink 1) o el mismo
+                # archivo que llega por dos raíces o montajes, así que se controlan todos
+                if archivo.inodo:
+                    identidad = (archivo.dispositivo, archivo.inodo)
+                    if identidad in enlazados:
+                        estadisticas["enlaces_omitidos"] += 1
+                        continue
+                    enlazados.add(identidad)
+                siguientes = deque([archivo] if not solo_candidatos else nuevos_candidatos(por_tamaño, archivo.tamaño, archivo))
+                while siguientes:
+                    siguiente = siguientes.popleft()
+                    if instantanea:
+                        # Si cambió de tamaño vuelve a entrar al índice con el nuevo
+                        actual = _refrescar(siguiente, cache, instantanea)
+                        if actual is None:
+                            continue
+                        if actual.tamaño != siguiente.tamaño and solo_candidatos:
+                            siguientes.extend(nuevos_candidatos(por_tamaño, actual.tamaño, actual))
+                            continue
+                        siguiente = actual
+                    while not lugares.acquire(timeout=0.1):
+                        if detener.is_set():
+                            return
+                    estadisticas["candidatos"] += 1
+                    enviar(1, trabajador_parcial, siguiente)
+        finally:
+            etapa["fin"] = time.monotonic()
+            fin_tamaño.set()
+            cola_resultados.put(None)  # despierta al agrupador
+
+    def ejecutar_tarea(prioridad, trabajador, args):
+        etapa = etapas["hash"]
+        with lock_estado:
+            if etapa["inicio"] is None:
+                etapa["inicio"] = time.monotonic()
+        if pool and trabajador in (trabajador_parcial, trabajador_completo):
+            lote = [args[0]] + planificador.tomar_similares(args[0], trabajador, tamaño_lote - 1)
+            etapa_lote = "completo" if trabajador is trabajador_completo else "parcial"
+            try:
+                resultados = trabajador_lote(etapa_lote, lote)
+            except Exception:
+                resultados = [(None, None, archivo) for archivo in lote]
         else:
-            errores.append(path)
+            try:
+                resultados = [trabajador(*args)]
+            except Exception:
+                resultados = [(None, None, args[-1])]
+        with lock_estado:
+            etapa["elementos"] += len(resultados)
+            etapa["fin"] = time.monotonic()
+        for resultado_tarea in resultados:
+            cola_resultados.put((prioridad, resultado_tarea))
+
+    # GRUPO_NUEVO trae los dos archivos; GRUPO_CRECIO trae el Grupo del almacén, que se lee
+    # en el momento (no es una copia)
+    def agregar_a_grupo(clave, archivo):
+        grupos.agregar(archivo, clave)
+        grupo = grupos.grupo(clave)
+        if grupo is None:
+            return
+        if len(grupo) == 2:
+            yield Evento(EVENTO_GRUPO_NUEVO, archivo, clave, list(grupo), contador, total)
+        else:
+            yield Evento(EVENTO_GRUPO_CRECIO, archivo, clave, grupo, contador, total)
+
+    def procesar(prioridad, resultado):
+        nonlocal contador
+        etapa, valor, carga = resultado
+        etapas["agrupar"]["elementos"] += 1
+        if prioridad == 1:
+            lugares.release()
+
+        if etapa == "comparado":
+            (size, parcial), iguales, fallidos = valor
+            por_ruta = {archivo.ruta: archivo for archivo in carga}
+            for i, rutas in enumerate(iguales):
+                clave = f"{size}:{parcial}#{i}"
+                for ruta in rutas:
+                    contador += 1
+                    archivo = por_ruta.pop(ruta)
+                    yield Evento(EVENTO_HASHEADO, archivo, clave, contador=contador, total=total)
+                    yield from agregar_a_grupo(clave, archivo)
+            for ruta in fallidos:
+                contador += 1
+                yield Evento(EVENTO_ERROR, por_ruta.pop(ruta), contador=contador, total=total)
+            # Los que quedaron solos también se leyeron, hasta el bloque donde difirieron
+            for archivo in por_ruta.values():
+                contador += 1
+                yield Evento(EVENTO_HASHEADO, archivo, contador=contador, total=total)
+            return
+
+        if isinstance(carga, list):
+            for archivo in carga:
+                contador += 1
+                yield Evento(EVENTO_ERROR, archivo, contador=contador, total=total)
+            return
+
+        archivo = carga
         contador += 1
-        if progress_callback:
-            progress_callback(contador, total)
+        if not valor:
+            yield Evento(EVENTO_ERROR, archivo, contador=contador, total=total)
+            return
+
+        if etapa == "completo":
+            estadisticas["hash_completo"] += 1
+            yield Evento(EVENTO_HASHEADO, archivo, valor, contador=contador, total=total)
+            yield from agregar_a_grupo(valor, archivo)
+            return
+
+        if muestra_es_completa(archivo.tamaño):
+            yield Evento(EVENTO_HASHEADO, archivo, valor, contador=contador, total=total)
+            yield from agregar_a_grupo(valor, archivo)
+            return
 
-    # Guardar cache solo para archivos existentes
-    nuevo_cache_existentes = {k: v for k, v in nuevo_cache.items() if os.path.exists(k)}
-    guardar_cache(cache_path, nuevo_cache_existentes)
+        yield Evento(EVENTO_HASHEADO, archivo, contador=contador, total=total)
+        if modo == MODO_COMPARAR and solo_candidatos:
+            # Se comparan al final, cuando cada grupo está completo
+            por_comparar.setdefault((archivo.tamaño, valor), []).append(archivo)
+            return
+        siguientes = [archivo] if not solo_candidatos else nuevos_candidatos(colisiones, (archivo.tamaño, valor), archivo)
+        for siguiente in siguientes:
+            enviar(0, trabajador_completo, siguiente)
+
+    def drenar():
+        nonlocal recibidas
+        ultimo_reporte = time.monotonic()
+        ultimo_guardado = time.monotonic()
+        while True:
+            # Primero el aviso de fin: si está puesto, la etapa de tamaño ya no va a enviar nada
+            terminado = fin_tamaño.is_set()
+            with lock_estado:
+                pendientes = enviadas - recibidas
+            if terminado and not pendientes:
+                return
+            try:
+                resultado = cola_resultados.get(timeout=1.0)
+            except Empty:
+                resultado = None
+            if resultado is not None:
+                recibidas += 1
+                yield from procesar(*resultado)
+            planificador.revisar()
+            if time.monotonic() - ultimo_guardado >= INTERVALO_GUARDADO:
+                ultimo_guardado = time.monotonic()
+                cache.punto_de_control(raices, estadisticas["total"], contador)
+            if time.monotonic() - ultimo_reporte >= INTERVALO_ETAPAS:
+                ultimo_reporte = time.monotonic()
+                yield Evento(EVENTO_ETAPAS, contador=contador, total=total, datos=resumen_etapas(etapas))
+
+    hilos = [threading.Thread(target=etapa_recorrido, daemon=True), threading.Thread(target=etapa_tamaño, daemon=True)]
+    planificador = PlanificadorDispositivos(
+        ejecutar_tarea, lambda dispositivo: cache.hilos_preferidos(dispositivo) or MAX_HILOS,
+        max_hilos=max_hilos, orden_fisico=orden_fisico)
+    for hilo in hilos:
+        hilo.start()
+
+    terminado = False
+    try:
+        etapas["agrupar"]["inicio"] = time.monotonic()
+        yield from drenar()
+
+        for clave, colision in por_comparar.items():
+            if len(colision) < 2:
+                continue
+            if len(colision) <= MAX_ABIERTOS:
+                estadisticas["comparados"] += len(colision)
+                enviar(0, trabajador_comparar, clave, colision, archivos=len(colision))
+            else:
+                for archivo in colision:
+                    enviar(0, trabajador_completo, archivo)
+        yield from drenar()
+        etapas["agrupar"]["fin"] = time.monotonic()
+        terminado = True
+    finally:
+        detener.set()
+        for hilo in hilos:
+            hilo.join()
+        planificador.detener()
+        if pool:
+            pool.shutdown(cancel_futures=True)
+        mejores = planificador.mejores_hilos()
+        for dispositivo, (hilos_dispositivo, velocidad) in mejores.items():
+            cache.guardar_hilos(dispositivo, hilos_dispositivo, velocidad / (1024 * 1024))
+        _cerrar_escaneo(cache, instantanea, raices, estadisticas, terminado, max_archivos)
+
+    estadisticas["bytes_leidos"] = etapas["hash"]["bytes"]
+    estadisticas["grupos_entre_raices"] = sum(
+        1 for grupo in grupos.values() if len({grupos.raices[i] for i in grupo.indices()}) > 1)
+    estadisticas["etapas"] = resumen_etapas(etapas)
+    estadisticas["hilos_hash"] = {dispositivo: hilos_dispositivo for dispositivo, (hilos_dispositivo, _) in mejores.items()}
+    yield Evento(EVENTO_FIN, contador=contador, total=total, datos=estadisticas)
+
+def _cerrar_escaneo(cache, instantanea, raices, estadisticas, terminado, max_archivos):
+    # Cierre común de iter_duplicados e iter_duplicados_externo, también si el escaneo se cortó.
+    # Olvidar archivos y carpetas que ya no existen solo tiene sentido con un recorrido completo:
+    # truncado, interrumpido o fallido no se sabe cuáles faltan
+    truncado = bool(max_archivos and estadisticas["total"] >= max_archivos)
+    terminado = terminado and "error_recorrido" not in estadisticas
+    guardar_cache(cache)
+    if terminado and not truncado:
+        cache.podar(raices)
+        if instantanea:
+            for raiz in raices:
+                instantanea.podar(raiz)
+    if terminado:
+        cache.terminar_escaneo(raices)
+    mantener_cache(cache)
+    estadisticas["reutilizados"] = cache.aciertos
+    estadisticas["cache"] = cache.estadisticas()
+    cache.cerrar()
+    if instantanea:
+        estadisticas["carpetas_reutilizadas"] = instantanea.reutilizadas
+        estadisticas["carpetas_listadas"] = instantanea.listadas
+        instantanea.cerrar()
+    estadisticas["omitidos_tamaño_unico"] = (
+        estadisticas["total"] - estadisticas["candidatos"] - estadisticas["enlaces_omitidos"])
+    estadisticas["raices"] = raices
+    estadisticas["truncado"] = truncado
+
+def _refrescar(archivo, cache, instantanea):
+    # Un listado reutilizado puede traer tamaño y mtime viejos (archivo editado en el lugar): cada
+    # candidato se vuelve a consultar antes de usarlo como clave del caché. Si cambió, el stat
+    # nuevo es el que se marca visto (así podar conserva su hash) y la carpeta se vuelve a listar
+    # en el próximo escaneo
+    actual = refrescar_registro(archivo)
+    if actual != archivo:
+        instantanea.invalidar(archivo.ruta)
+        if actual is not None:
+            cache.marcar_visto(actual)
+    return actual
+
+def _abrir_instantanea(cache_path):
+    try:
+        return InstantaneaDirectorios(ruta_instantanea(cache_path))
+    except Exception as e:
+        print(f"Error al abrir instantánea de carpetas: {e}")
+        return None
+
+def escanear_y_hash(carpeta, progress_callback=None, max_hilos=None, max_archivos=MAX_ARCHIVOS,
+                    solo_candidatos=True, estadisticas=None, modo=MODO_HASH, hilos_recorrido=HILOS_RECORRIDO,
+                    cache_path=None, backend=BACKEND_HILOS, tamaño_lote=TAMAÑO_LOTE, orden_fisico=False,
+                    tamaño_bloque=TAMAÑO_BLOQUE, algoritmo=ALGORITMO, reusar_carpetas=True):
+    # Devuelve un AlmacenResultados (se lee como un diccionario clave -> archivos) y las rutas con error
+    hashes = AlmacenResultados()
+    errores = []
+    eventos = iter_duplicados(carpeta, max_hilos, max_archivos, solo_candidatos, modo, hilos_recorrido, cache_path,
+                              backend=backend, tamaño_lote=tamaño_lote, orden_fisico=orden_fisico,
+                              tamaño_bloque=tamaño_bloque, algoritmo=algoritmo, reusar_carpetas=reusar_carpetas,
+                              almacen=hashes)
+    for evento in eventos:
+        if evento.tipo == EVENTO_ERROR:
+            errores.append(evento.archivo.ruta)
+        elif evento.tipo == EVENTO_FIN and estadisticas is not None:
+            estadisticas.update(evento.datos)
+        if progress_callback and evento.tipo in (EVENTO_HASHEADO, EVENTO_ERROR):
+            progress_callback(evento.contador, evento.total)
 
     return hashes, errores
 
+def _bytes_a_leer(archivo, clave):
+    return min(archivo.tamaño, 2 * MAX_BYTES) if clave == "parcial" else archivo.tamaño
+
+def _registrar_hash(cache, archivo, clave, valor):
+    entrada = {clave: valor}
+    if clave == "parcial" and muestra_es_completa(archivo.tamaño):
+        entrada["hash"] = valor
+    cache.registrar(archivo, entrada)
+
+def hashear_con_cache(cache, archivo, clave, tamaño_bloque, algoritmo):
+    # Devuelve (hash, bytes leídos); clave es "parcial" o "hash"
+    valor = cache.buscar(archivo, clave)
+    if valor:
+        return valor, 0
+    if clave == "parcial":
+        valor = hash_parcial(archivo.ruta, tamaño_bloque=tamaño_bloque, algoritmo=algoritmo)
+    else:
+        valor = hash_completo(archivo.ruta, tamaño_bloque, algoritmo)
+    if valor:
+        _registrar_hash(cache, archivo, clave, valor)
+    return valor, _bytes_a_leer(archivo, clave)
+
+def _mapear_acotado(executor, funcion, elementos, ventana):
+    # Como executor.map, pero consume la entrada de a poco: como mucho `ventana` tareas en vuelo
+    en_vuelo = deque()
+    for elemento in elementos:
+        en_vuelo.append((elemento, executor.submit(funcion, elemento)))
+        if len(en_vuelo) >= ventana:
+            elemento, futuro = en_vuelo.popleft()
+            yield elemento, futuro.result()
+    while en_vuelo:
+        elemento, futuro = en_vuelo.popleft()
+        yield elemento, futuro.result()
+
+def _registro(clave, archivo):
+    # Ordena por (tamaño, clave) y lleva el archivo completo para reconstruirlo al fusionar
+    return (archivo.tamaño, clave) + tuple(archivo)
+
+def iter_duplicados_externo(carpeta, max_hilos=None, max_archivos=None, hilos_recorrido=HILOS_RECORRIDO, cache_path=None,
+                            tamaño_bloque=TAMAÑO_BLOQUE, algoritmo=ALGORITMO, directorio_temporal=None,
+                            registros_por_corrida=REGISTROS_POR_CORRIDA, reusar_carpetas=True):
+    # Modo sin tope de archivos: en lugar de índices en memoria, cada etapa escribe registros
+    # (tamaño, clave, archivo) en corridas ordenadas en disco y la siguiente las fusiona.
+    #   tamaño -> muestra (solo tamaños repetidos) -> hash completo (solo muestras repetidas) -> grupos
+    # La memoria queda acotada por registros_por_corrida y el grupo más grande de un mismo tamaño.
+    # Los grupos salen completos (EVENTO_GRUPO_NUEVO) al final, ordenados por tamaño
+    if algoritmo not in ALGORITMOS:
+        raise ValueError(f"Algoritmo de hash desconocido: {algoritmo}")
+    raices = [carpeta] if isinstance(carpeta, str) else normalizar_raices(carpeta)
+    hilos_hash = max_hilos or MAX_HILOS
+    cache = cargar_cache(cache_path, algoritmo)
+    instantanea = _abrir_instantanea(cache_path) if reusar_carpetas else None
+    cache.iniciar_recorrido()
+    previo = cache.iniciar_escaneo(raices)
+    por_tamaño, por_parcial, por_hash = (
+        CorridasOrdenadas(directorio_temporal, registros_por_corrida) for _ in range(3))
+    executor = ThreadPoolExecutor(max_workers=hilos_hash)
+    estadisticas = {"total": 0, "candidatos": 0, "hash_completo": 0, "enlaces_omitidos": 0, "bytes_leidos": 0,
+                    "grupos": 0, "reanudado": previo is not None}
+    contador = 0
+    total = 0
+    ultimo_guardado = time.monotonic()
+
+    def hashear(clave):
+        return lambda archivo: hashear_con_cache(cache, archivo, clave, tamaño_bloque, algoritmo)
+
+    def contar(leidos):
+        nonlocal contador, ultimo_guardado
+        contador += 1
+        estadisticas["bytes_leidos"] += leidos
+        if time.monotonic() - ultimo_guardado >= INTERVALO_GUARDADO:
+            ultimo_guardado = time.monotonic()
+            cache.punto_de_control(raices, estadisticas["total"], contador)
+
+    # Un tamaño que aparece una sola vez no puede tener duplicados; dentro de cada tamaño los
+    # registros quedan ordenados por (dispositivo, inodo), así los enlaces duros quedan juntos
+    def candidatos():
+        nonlocal total
+        for tamaño, registros in groupby(por_tamaño, key=lambda registro: registro[0]):
+            archivos = []
+            anterior = None
+            for registro in registros:
+                if registro[1] == anterior and registro[1][1]:
+                    estadisticas["enlaces_omitidos"] += 1
+                    continue
+                anterior = registro[1]
+                archivos.append(Archivo(*registro[2:]))
+            if len(archivos) > 1 and instantanea:
+                # Como en iter_duplicados: el listado reutilizado puede traer un stat viejo. Acá las
+                # corridas ya están ordenadas por tamaño, así que el que cambió de tamaño queda afuera
+                archivos = [actual for actual in (_refrescar(archivo, cache, instantanea) for archivo in archivos)
+                            if actual is not None and actual.tamaño == tamaño]
+            if len(archivos) > 1:
+                estadisticas["candidatos"] += len(archivos)
+                total += len(archivos)
+                yield from archivos
+
+    # Solo los archivos cuyo (tamaño, muestra) se repite necesitan el hash completo
+    def colisiones():
+        nonlocal total
+        for _, registros in groupby(por_parcial, key=lambda registro: registro[:2]):
+            archivos = [Archivo(*registro[2:]) for registro in registros]
+            if len(archivos) > 1:
+                estadisticas["hash_completo"] += len(archivos)
+                total += len(archivos)
+                yield from archivos
+
+    terminado = False
+    try:
+        try:
+            for archivo in iterar_raices(raices, EXTENSIONES_VALIDAS, limite=max_archivos, hilos=hilos_recorrido,
+                                         instantanea=instantanea):
+                estadisticas["total"] += 1
+                cache.marcar_visto(archivo)
+                por_tamaño.agregar(_registro((archivo.dispositivo, archivo.inodo), archivo))
+        except Exception as e:
+            # Como en iter_duplicados: se agrupa lo recorrido, pero el escaneo no cuenta como completo
+            print(f"Error al recorrer carpetas: {e}")
+            estadisticas["error_recorrido"] = str(e)
+
+        ventana = hilos_hash * VENTANA_POR_HILO
+        for archivo, (valor, leidos) in _mapear_acotado(executor, hashear("parcial"), candidatos(), ventana):
+            contar(leidos)
+            if not valor:
+                yield Evento(EVENTO_ERROR, archivo, contador=contador, total=total)
+            elif muestra_es_completa(archivo.tamaño):
+                por_hash.agregar(_registro(valor, archivo))
+                yield Evento(EVENTO_HASHEADO, archivo, valor, contador=contador, total=total)
+            else:
+                por_parcial.agregar(_registro(valor, archivo))
+                yield Evento(EVENTO_HASHEADO, archivo, contador=contador, total=total)
+        por_tamaño.cerrar()
+
+        for archivo, (valor, leidos) in _mapear_acotado(executor, hashear("hash"), colisiones(), ventana):
+            contar(leidos)
+            if not valor:
+                yield Evento(EVENTO_ERROR, archivo, contador=contador, total=total)
+            else:
+                por_hash.agregar(_registro(valor, archivo))
+                yield Evento(EVENTO_HASHEADO, archivo, valor, contador=contador, total=total)
+        por_parcial.cerrar()
+
+        for (_, clave), registros in groupby(por_hash, key=lambda registro: registro[:2]):
+            grupo = [Archivo(*registro[2:]) for registro in registros]
+            if len(grupo) > 1:
+                estadisticas["grupos"] += 1
+                yield Evento(EVENTO_GRUPO_NUEVO, grupo[-1], clave, grupo, contador, total)
+        terminado = True
+    finally:
+        estadisticas["corridas"] = por_tamaño.volcadas + por_parcial.volcadas + por_hash.volcadas
+        executor.shutdown(cancel_futures=True)
+        for corridas in (por_tamaño, por_parcial, por_hash):
+            corridas.cerrar()
+        _cerrar_escaneo(cache, instantanea, raices, estadisticas, terminado, max_archivos)
+
+    yield Evento(EVENTO_FIN, contador=contador, total=total, datos=estadisticas)
+
+def comparar_carpetas(carpeta_a, carpeta_b, max_hilos=MAX_HILOS, cache_path=None, algoritmo=ALGORITMO,
+                      tamaño_bloque=TAMAÑO_BLOQUE, estadisticas=None, progress_callback=None):
+    # Motor A contra B: A se indexa por tamaño sin leer nada, de B solo se leen los archivos
+    # con un tamaño que existe en A y de A solo los de esos tamaños. Primero la muestra
+    # (inicio y final) y el hash completo solo para los que coinciden.
+    # Devuelve los pares (ruta en B, ruta igual en A) y las rutas que no se pudieron leer
+    if algoritmo not in ALGORITMOS:
+        raise ValueError(f"Algoritmo de hash desconocido: {algoritmo}")
+    # Si una carpeta está dentro de la otra, sus archivos pertenecen solo a la más interna
+    b_en_a = esta_dentro(carpeta_b, carpeta_a)
+    a_en_b = esta_dentro(carpeta_a, carpeta_b)
+    por_tamaño = {}
+    total_a = 0
+    # Varios nombres del mismo inodo en A (enlaces duros o symlinks) son un solo archivo: se
+    # indexa (y se lee) uno solo
+    enlazados_a = set()
+    enlaces_a = 0
+    for archivo in iterar_archivos(carpeta_a, EXTENSIONES_VALIDAS):
+        if not (b_en_a and esta_dentro(archivo.ruta, carpeta_b)):
+            total_a += 1
+            if archivo.inodo:
+                identidad = (archivo.dispositivo, archivo.inodo)
+                if identidad in enlazados_a:
+                    enlaces_a += 1
+                    continue
+                enlazados_a.add(identidad)
+            por_tamaño.setdefault(archivo.tamaño, []).append(archivo)
+    total_b = 0
+    candidatos_b = []
+    for archivo in iterar_archivos(carpeta_b, EXTENSIONES_VALIDAS):
+        if not (a_en_b and esta_dentro(archivo.ruta, carpeta_a)):
+            total_b += 1
+            if archivo.tamaño in por_tamaño:
+                candidatos_b.append(archivo)
+
+    cache = cargar_cache(cache_path, algoritmo)
+    errores = []
+    stats = {"total_a": total_a, "total_b": total_b, "candidatos_b": len(candidatos_b), "enlaces_omitidos_a": enlaces_a,
+             "hash_completo": 0, "bytes_leidos": 0, "pares": 0}
+    contador = 0
+    total = 0
+
+    def hashear_todos(executor, lista, clave):
+        nonlocal contador
+        valores = {}
+        resultados = executor.map(lambda archivo: hashear_con_cache(cache, archivo, clave, tamaño_bloque, algoritmo), lista)
+        for archivo, (valor, leidos) in zip(lista, resultados):
+            contador += 1
+            stats["bytes_leidos"] += leidos
+            if valor:
+                valores[archivo.ruta] = valor
+            else:
+                errores.append(archivo.ruta)
+            if progress_callback:
+                progress_callback(contador, total)
+        return valores
+
+    pares = []
+    try:
+        with ThreadPoolExecutor(max_workers=max_hilos) as executor:
+            lista = [a for tamaño in {b.tamaño for b in candidatos_b} for a in por_tamaño[tamaño]] + candidatos_b
+            total = len(lista)
+            parciales = hashear_todos(executor, lista, "parcial")
+
+            a_por_parcial = {}
+            for tamaño in {b.tamaño for b in candidatos_b}:
+                for a in por_tamaño[tamaño]:
+                    if a.ruta in parciales:
+                        a_por_parcial.setdefault((tamaño, parciales[a.ruta]), []).append(a)
+            siguen_b = [b for b in candidatos_b if (b.tamaño, parciales.get(b.ruta)) in a_por_parcial]
+
+            # Si la muestra cubre todo el archivo ya es el hash completo
+            completos = {}
+            por_leer = []
+            for archivo in siguen_b + [a for b in siguen_b for a in a_por_parcial[(b.tamaño, parciales[b.ruta])]]:
+                if muestra_es_completa(archivo.tamaño):
+                    completos[archivo.ruta] = parciales[archivo.ruta]
+                elif archivo.ruta not in completos:
+                    completos[archivo.ruta] = None
+                    por_leer.append(archivo)
+            total += len(por_leer)
+            stats["hash_completo"] = len(por_leer)
+            completos.update(hashear_todos(executor, por_leer, "hash"))
+
+        for b in siguen_b:
+            hash_b = completos.get(b.ruta)
+            if not hash_b:
+                continue
+            for a in a_por_parcial[(b.tamaño, parciales[b.ruta])]:
+                # Un enlace duro al mismo inodo no es una copia: borrarlo no libera nada
+                if completos.get(a.ruta) == hash_b and (a.dispositivo, a.inodo) != (b.dispositivo, b.inodo):
+                    pares.append((b.ruta, a.ruta))
+                    break
+    finally:
+        guardar_cache(cache)
+        cache.cerrar()
+
+    stats["pares"] = len(pares)
+    if estadisticas is not None:
+        estadisticas.update(stats)
+    return pares, errores
+
 def filtrar_duplicados(hashes):
     return {h: r for h, r in hashes.items() if len(r) > 1}
+
+def raices_de_grupo(grupo):
+    return sorted({archivo.raiz for archivo in grupo})
+
+def filtrar_entre_raices(hashes):
+    # Solo los grupos con copias en más de una raíz
+    return {h: r for h, r in hashes.items() if len(r) > 1 and len(raices_de_grupo(r)) > 1}
+
+def _llenar(f, buffer):
+    # Sin buffering, readinto puede leer menos de lo pedido aunque no sea el final
+    vista = memoryview(buffer)
+    leidos = 0
+    while leidos < len(vista):
+        n = f.readinto(vista[leidos:])
+        if not n:
+            break
+        leidos += n
+    return leidos
+
+def _particionar(miembros, leidos):
+    # Agrupa los miembros cuyo último bloque leído es idéntico
+    subgrupos = []
+    for miembro, n in zip(miembros, leidos):
+        vista = memoryview(miembro[2])[:n]
+        for referencia, sub in subgrupos:
+            if referencia == vista:
+                sub.append(miembro)
+                break
+        else:
+            subgrupos.append((vista, [miembro]))
+    return [sub for _, sub in subgrupos]
+
+def comparar_grupo(rutas, inicio=0, tamaño_bloque=BLOQUE_COMPARACION, estadisticas=None):
+    # Lee todos los archivos del grupo a la par y los separa en cuanto difieren;
+    # un archivo que queda solo deja de leerse en ese mismo bloque
+    errores = []
+    iguales = []
+    bytes_leidos = 0
+    abiertos = []
+    for ruta in rutas:
+        try:
+            f = open(ruta, "rb", buffering=0)
+            aconsejar(f, "SEQUENTIAL")
+            f.seek(inicio)
+            abiertos.append((ruta, f, bytearray(tamaño_bloque)))
+        except Exception:
+            errores.append(ruta)
+
+    pendientes = [abiertos] if len(abiertos) > 1 else []
+    try:
+        while pendientes:
+            grupo = pendientes.pop()
+            miembros, leidos = [], []
+            for miembro in grupo:
+                try:
+                    n = _llenar(miembro[1], miembro[2])
+                except Exception:
+                    errores.append(miembro[0])
+                    continue
+                bytes_leidos += n
+                miembros.append(miembro)
+                leidos.append(n)
+
+            for sub in _particionar(miembros, leidos):
+                if len(sub) < 2:
+                    continue
+                if leidos[miembros.index(sub[0])] == 0:
+                    iguales.append([ruta for ruta, _, _ in sub])
+                else:
+                    pendientes.append(sub)
+    finally:
+        for _, f, _ in abiertos:
+            if LIBERAR_CACHE:
+                aconsejar(f, "DONTNEED")
+            f.close()
+
+    if estadisticas is not None:
+        estadisticas["bytes_leidos"] = bytes_leidos
+    return iguales, errores
@@ -1,33 +1,176 @@
 import os
 import hashlib
-import json
+import threading
+import time
+from array import array
+from core.cache import MAX_ENTRADAS_CACHE, MAX_MB_CACHE, CacheHashes, ruta_cache_global
 
-MAX_BYTES = 1024 * 1024  # 1 MB para hashing parcial
+MAX_BYTES = 64 * 1024  # 64 KB del inicio y 64 KB del final para hashing parcial
+TAMAÑO_BLOQUE = 1024 * 1024
+# Después de leer un archivo se le pide al kernel que suelte sus páginas, para que el
+# escaneo no desaloje del page cache lo que usan otros procesos
+LIBERAR_CACHE = True
 
-def hash_parcial(path, max_bytes=MAX_BYTES):
+# Algoritmos disponibles: nombre -> función que crea un objeto hash nuevo.
+# El nombre se guarda en cada entrada del caché, así cambiar de algoritmo no mezcla digests
+TAMAÑO_DIGEST_BLAKE2B = 16
+ALGORITMOS = {
+    "md5": hashlib.md5,
+    "blake2b": lambda: hashlib.blake2b(digest_size=TAMAÑO_DIGEST_BLAKE2B),
+}
+ALGORITMO = "md5"
+
+# Hashes no criptográficos más rápidos, solo si están instalados
+try:
+    import xxhash
+    ALGORITMOS["xxh3_128"] = xxhash.xxh3_128
+    ALGORITMOS["xxh64"] = xxhash.xxh64
+except ImportError:
+    pass
+
+try:
+    import blake3
+    ALGORITMOS["blake3"] = blake3.blake3
+except ImportError:
+    pass
+
+def registrar_algoritmo(nombre, fabrica):
+    ALGORITMOS[nombre] = fabrica
+
+def nuevo_hash(algoritmo=ALGORITMO):
+    try:
+        return ALGORITMOS[algoritmo]()
+    except KeyError:
+        raise ValueError(f"Algoritmo de hash desconocido: {algoritmo}") from None
+
+def medir_algoritmos(megabytes=256, tamaño_bloque=TAMAÑO_BLOQUE):
+    # MB/s de cada algoritmo hasheando datos en memoria (sin E/S de disco)
+    bloque = memoryview(os.urandom(tamaño_bloque))
+    bloques = max(1, megabytes * 1024 * 1024 // tamaño_bloque)
+    resultados = {}
+    for nombre in ALGORITMOS:
+        hasher = nuevo_hash(nombre)
+        inicio = time.perf_counter()
+        for _ in range(bloques):
+            hasher.update(bloque)
+        hasher.digest()
+        segundos = time.perf_counter() - inicio
+        resultados[nombre] = bloques * tamaño_bloque / (1024 * 1024) / segundos if segundos else 0.0
+    return resultados
+
+def muestra_es_completa(tamaño, max_bytes=MAX_BYTES):
+    # Si la muestra cubre todo el archivo, el hash parcial ya es el hash completo
+    return tamaño <= 2 * max_bytes
+
+_buffers = threading.local()
+
+def _buffer(tamaño_bloque):
+    # Un buffer reutilizable por hilo: readinto no crea un objeto bytes por bloque
+    buffer = getattr(_buffers, "buffer", None)
+    if buffer is None or len(buffer) != tamaño_bloque:
+        buffer = _buffers.buffer = bytearray(tamaño_bloque)
+    return memoryview(buffer)
+
+def aconsejar(f, nombre):
+    # nombre: "SEQUENTIAL", "DONTNEED", ... (posix_fadvise; no hace nada fuera de POSIX)
+    consejo = getattr(os, f"POSIX_FADV_{nombre}", None)
+    if consejo is not None and hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, consejo)
+        except OSError:
+            pass
+
+def _leer(hasher, f, vista, cantidad=None):
+    restante = cantidad
+    while restante is None or restante > 0:
+        destino = vista if restante is None else vista[:min(len(vista), restante)]
+        n = f.readinto(destino)
+        if not n:
+            break
+        hasher.update(destino[:n])
+        if restante is not None:
+            restante -= n
+
+def digest_parcial(path, max_bytes=MAX_BYTES, tamaño_bloque=TAMAÑO_BLOQUE, liberar_cache=LIBERAR_CACHE,
+                   algoritmo=ALGORITMO):
     try:
-        hash_md5 = hashlib.md5()
-        tamaño = os.path.getsize(path)
-        with open(path, "rb") as f:
-            while chunk := f.read(8192):
-                hash_md5.update(chunk)
+        hasher = nuevo_hash(algoritmo)
+        vista = _buffer(tamaño_bloque)
+        with open(path, "rb", buffering=0) as f:
+            tamaño = os.fstat(f.fileno()).st_size
+            if muestra_es_completa(tamaño, max_bytes):
+                _leer(hasher, f, vista)
+            else:
+                _leer(hasher, f, vista, max_bytes)
+                f.seek(-max_bytes, os.SEEK_END)
+                _leer(hasher, f, vista, max_bytes)
+            if liberar_cache:
+                aconsejar(f, "DONTNEED")
 
-        return hash_md5.hexdigest()
+        return hasher.digest()
     except Exception:
         return None
 
-def cargar_cache(cache_path):
-    if os.path.isfile(cache_path):
-        try:
-            with open(cache_path, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except Exception:
-            return {}
-    return {}
+def digest_completo(path, tamaño_bloque=TAMAÑO_BLOQUE, liberar_cache=LIBERAR_CACHE, algoritmo=ALGORITMO):
+    try:
+        hasher = nuevo_hash(algoritmo)
+        vista = _buffer(tamaño_bloque)
+        with open(path, "rb", buffering=0) as f:
+            aconsejar(f, "SEQUENTIAL")
+            _leer(hasher, f, vista)
+            if liberar_cache:
+                aconsejar(f, "DONTNEED")
+
+        return hasher.digest()
+    except Exception:
+        return None
+
+def hash_parcial(path, max_bytes=MAX_BYTES, tamaño_bloque=TAMAÑO_BLOQUE, algoritmo=ALGORITMO):
+    digest = digest_parcial(path, max_bytes, tamaño_bloque, algoritmo=algoritmo)
+    return digest.hex() if digest else None
+
+def hash_completo(path, tamaño_bloque=TAMAÑO_BLOQUE, algoritmo=ALGORITMO):
+    digest = digest_completo(path, tamaño_bloque, algoritmo=algoritmo)
+    return digest.hex() if digest else None
+
+def hashear_lote(rutas, completo=False, max_bytes=MAX_BYTES, tamaño_bloque=TAMAÑO_BLOQUE, algoritmo=ALGORITMO):
+    # Pensada para correr en otro proceso: devuelve arreglos compactos (índice, digest)
+    # en lugar de un objeto por archivo, para que el costo de IPC por archivo sea mínimo
+    indices = array("I")
+    digests = bytearray()
+    tamaño_digest = nuevo_hash(algoritmo).digest_size
+    for i, ruta in enumerate(rutas):
+        if completo:
+            digest = digest_completo(ruta, tamaño_bloque, algoritmo=algoritmo)
+        else:
+            digest = digest_parcial(ruta, max_bytes, tamaño_bloque, algoritmo=algoritmo)
+        if digest:
+            indices.append(i)
+            digests += digest
+    return indices, bytes(digests), tamaño_digest
+
+def cargar_cache(cache_path=None, algoritmo=ALGORITMO):
+    try:
+        return CacheHashes(cache_path or ruta_cache_global(), algoritmo)
+    except Exception as e:
+        print(f"Error al abrir caché: {e}")
+        return CacheHashes(":memory:", algoritmo)
+
+def mantener_cache(cache, max_entradas=MAX_ENTRADAS_CACHE, max_mb=MAX_MB_CACHE):
+    # Recorta el caché por LRU y, si quedó mucho espacio libre, lo compacta. Se hace acá, antes de
+    # cerrar el caché y no en otro hilo: un VACUUM todavía en curso dejaría la base bloqueada para
+    # el próximo escaneo (la ventana o el cron pueden arrancar otro enseguida)
+    try:
+        cache.recortar(max_entradas, max_mb)
+        if cache.necesita_compactar():
+            cache.compactar()
+    except Exception as e:
+        print(f"Error al mantener caché: {e}")
 
-def guardar_cache(cache_path, cache_data):
+def guardar_cache(cache, cache_data=None):
     try:
-        with open(cache_path, "w", encoding="utf-8") as f:
-            json.dump(cache_data, f, indent=2)
+        if cache_data:
+            cache.actualizar(cache_data)
+        cache.vaciar()
     except Exception as e:
         print(f"Error al guardar caché: {e}")
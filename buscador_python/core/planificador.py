@@ -0,0 +1,142 @@
+import itertools
+import struct
+import threading
+from queue import PriorityQueue, Empty
+from core.concurrencia import HILOS_MAXIMOS, LimiteConcurrencia, Autoajuste
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+FS_IOC_FIEMAP = 0xC020660B
+_CABECERA_FIEMAP = struct.Struct("=QQLLLL")
+_EXTENSION_FIEMAP = struct.Struct("=QQQQQLLLL")
+
+def desplazamiento_fisico(ruta):
+    # Posición física del primer bloque del archivo (FIEMAP en Linux); None si el
+    # sistema de archivos no la expone
+    if fcntl is None:
+        return None
+    try:
+        with open(ruta, "rb") as f:
+            buffer = bytearray(_CABECERA_FIEMAP.pack(0, 2 ** 64 - 1, 0, 0, 1, 0) + bytes(_EXTENSION_FIEMAP.size))
+            fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, buffer)
+        if _CABECERA_FIEMAP.unpack_from(buffer)[3] == 0:
+            return None
+        return _EXTENSION_FIEMAP.unpack_from(buffer, _CABECERA_FIEMAP.size)[1]
+    except Exception:
+        return None
+
+class Dispositivo:
+    def __init__(self, hilos_iniciales, hilos_maximos, autoajustar):
+        self.cola = PriorityQueue()
+        self.limite = LimiteConcurrencia(hilos_iniciales)
+        self.ajuste = Autoajuste(self.limite, maximo=hilos_maximos) if autoajustar else None
+        self.hilos = []
+        self.bytes_leidos = 0
+
+class PlanificadorDispositivos:
+    # Una cola y un presupuesto de hilos por dispositivo, para que dos discos no compitan
+    # por el mismo pool. Dentro de cada cola las lecturas salen por prioridad y luego por
+    # inodo (o posición física), así un disco rotacional lee casi en secuencia
+    def __init__(self, ejecutar, hilos_preferidos, max_hilos=None, orden_fisico=False):
+        self._ejecutar = ejecutar
+        self._hilos_preferidos = hilos_preferidos
+        self._max_hilos = max_hilos
+        self._orden_fisico = orden_fisico
+        self._dispositivos = {}
+        self._lock = threading.Lock()
+        self._secuencia = itertools.count()
+
+    @property
+    def hilos_maximos(self):
+        return self._max_hilos or HILOS_MAXIMOS
+
+    def _dispositivo(self, dispositivo):
+        with self._lock:
+            estado = self._dispositivos.get(dispositivo)
+            if estado is None:
+                autoajustar = self._max_hilos is None
+                iniciales = self._max_hilos or self._hilos_preferidos(dispositivo)
+                estado = Dispositivo(iniciales, self.hilos_maximos, autoajustar)
+                self._dispositivos[dispositivo] = estado
+                for _ in range(self.hilos_maximos):
+                    hilo = threading.Thread(target=self._trabajar, args=(estado,), daemon=True)
+                    estado.hilos.append(hilo)
+                    hilo.start()
+            return estado
+
+    def orden(self, archivo):
+        if self._orden_fisico:
+            posicion = desplazamiento_fisico(archivo.ruta)
+            if posicion is not None:
+                return posicion
+        return archivo.inodo
+
+    def enviar(self, archivo, prioridad, trabajador, args):
+        estado = self._dispositivo(archivo.dispositivo)
+        estado.cola.put((prioridad, self.orden(archivo), next(self._secuencia), trabajador, args))
+
+    def tomar_similares(self, archivo, trabajador, cantidad):
+        # Saca de la cola del mismo dispositivo hasta `cantidad` tareas del mismo tipo
+        estado = self._dispositivo(archivo.dispositivo)
+        similares = []
+        otras = []
+        while len(similares) < cantidad:
+            try:
+                item = estado.cola.get_nowait()
+            except Empty:
+                break
+            if item[3] is trabajador:
+                similares.append(item[4][0])
+            else:
+                otras.append(item)
+        for item in otras:
+            estado.cola.put(item)
+        return similares
+
+    def sumar_bytes(self, dispositivo, n):
+        estado = self._dispositivos.get(dispositivo)
+        if estado is not None:
+            with self._lock:
+                estado.bytes_leidos += n
+
+    def revisar(self):
+        for estado in list(self._dispositivos.values()):
+            if estado.ajuste:
+                estado.ajuste.revisar(estado.bytes_leidos)
+
+    def _trabajar(self, estado):
+        while True:
+            estado.limite.entrar()
+            try:
+                prioridad, _, _, trabajador, args = estado.cola.get()
+                if trabajador is None:
+                    return
+                self._ejecutar(prioridad, trabajador, args)
+            finally:
+                estado.limite.salir()
+
+    def detener(self):
+        # Descarta lo que queda en las colas y espera a que terminen los hilos
+        for estado in list(self._dispositivos.values()):
+            while True:
+                try:
+                    estado.cola.get_nowait()
+                except Empty:
+                    break
+            estado.limite.ajustar(len(estado.hilos))
+            for _ in estado.hilos:
+                estado.cola.put((3, 0, next(self._secuencia), None, None))
+        for estado in list(self._dispositivos.values()):
+            for hilo in estado.hilos:
+                hilo.join()
+
+    def mejores_hilos(self):
+        # {dispositivo: (hilos, bytes/s)} medido por el autoajuste de cada dispositivo
+        return {
+            dispositivo: estado.ajuste.mejor
+            for dispositivo, estado in self._dispositivos.items()
+            if estado.ajuste and estado.ajuste.mejor[1]
+        }
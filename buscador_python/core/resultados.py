@@ -0,0 +1,155 @@
+import os
+from array import array
+from core.archivos import Archivo
+
+def _clave_interna(clave):
+    # Los digests hex se guardan como bytes (la mitad de memoria); otras claves quedan igual
+    try:
+        return bytes.fromhex(clave)
+    except (TypeError, ValueError):
+        return clave
+
+class Grupo:
+    # Archivos con la misma clave. No guarda una lista propia: los miembros están encadenados
+    # en la columna `siguiente` del almacén y los Archivo se arman al leerlos
+    __slots__ = ("almacen", "_clave", "primero", "ultimo", "cantidad")
+
+    def __init__(self, almacen, clave, primero):
+        self.almacen = almacen
+        self._clave = clave
+        self.primero = primero
+        self.ultimo = primero
+        self.cantidad = 1
+
+    @property
+    def clave(self):
+        return self._clave.hex() if isinstance(self._clave, bytes) else self._clave
+
+    def indices(self):
+        siguiente = self.almacen.siguiente
+        indice = self.primero
+        while indice >= 0:
+            yield indice
+            indice = siguiente[indice]
+
+    def __len__(self):
+        return self.cantidad
+
+    def __iter__(self):
+        return (self.almacen.archivo(i) for i in self.indices())
+
+    def __getitem__(self, posicion):
+        archivos = [self.almacen.archivo(i) for i in self.indices()]
+        return archivos[posicion]
+
+class AlmacenResultados:
+    # Resultados de un escaneo en columnas: cada carpeta se guarda una sola vez, los nombres van
+    # seguidos en un solo bytearray y el resto son arreglos de tamaño, mtime, inodo, etc.
+    # Un digest que aparece una sola vez solo guarda el índice de su archivo; recién con el
+    # segundo archivo se crea el Grupo (y solo esos se ven en grupos/items)
+    def __init__(self):
+        self.directorios = []
+        self._indice_directorios = {}
+        self.directorio = array("I")
+        self._nombres = bytearray()
+        self._fin_nombres = array("Q")
+        self.tamaños = array("Q")
+        self.mtimes = array("q")
+        self.inodos = array("Q")
+        self.dispositivos = array("Q")
+        self.enlaces = array("I")
+        self.raices = array("H")
+        self.siguiente = array("i")
+        self.grupos = {}
+        self._unicos = {}
+
+    def agregar(self, archivo, clave=None):
+        directorio, nombre = os.path.split(archivo.ruta)
+        indice_directorio = self._indice_directorios.get(directorio)
+        if indice_directorio is None:
+            indice_directorio = self._indice_directorios[directorio] = len(self.directorios)
+            self.directorios.append(directorio)
+        indice = len(self._fin_nombres)
+        self.directorio.append(indice_directorio)
+        self._nombres += os.fsencode(nombre)
+        self._fin_nombres.append(len(self._nombres))
+        self.tamaños.append(archivo.tamaño)
+        self.mtimes.append(archivo.mtime_ns)
+        self.inodos.append(archivo.inodo)
+        self.dispositivos.append(archivo.dispositivo)
+        self.enlaces.append(archivo.enlaces)
+        self.raices.append(archivo.raiz)
+        self.siguiente.append(-1)
+        if clave is not None:
+            clave = _clave_interna(clave)
+            grupo = self.grupos.get(clave)
+            if grupo is None:
+                primero = self._unicos.pop(clave, None)
+                if primero is None:
+                    self._unicos[clave] = indice
+                    return indice
+                grupo = self.grupos[clave] = Grupo(self, clave, primero)
+            self.siguiente[grupo.ultimo] = indice
+            grupo.ultimo = indice
+            grupo.cantidad += 1
+        return indice
+
+    def quitar(self, clave, ruta):
+        # Saca ruta del grupo clave (el modo vigilancia informa archivos borrados o cambiados) y
+        # devuelve los índices que salieron: si el grupo queda con un solo archivo sale entero.
+        # Las columnas no se compactan, el almacén solo crece
+        clave = _clave_interna(clave)
+        grupo = self.grupos.get(clave)
+        if grupo is None:
+            return []
+        anterior = -1
+        for indice in grupo.indices():
+            if self.ruta(indice) == ruta:
+                break
+            anterior = indice
+        else:
+            return []
+        if grupo.cantidad <= 2:
+            del self.grupos[clave]
+            return list(grupo.indices())
+        if anterior < 0:
+            grupo.primero = self.siguiente[indice]
+        else:
+            self.siguiente[anterior] = self.siguiente[indice]
+        if grupo.ultimo == indice:
+            grupo.ultimo = anterior
+        grupo.cantidad -= 1
+        return [indice]
+
+    def nombre(self, indice):
+        inicio = self._fin_nombres[indice - 1] if indice else 0
+        return os.fsdecode(bytes(self._nombres[inicio:self._fin_nombres[indice]]))
+
+    def ruta(self, indice):
+        return os.path.join(self.directorios[self.directorio[indice]], self.nombre(indice))
+
+    def archivo(self, indice):
+        return Archivo(self.ruta(indice), self.tamaños[indice], self.mtimes[indice], self.inodos[indice],
+                       self.dispositivos[indice], self.enlaces[indice], self.raices[indice])
+
+    def __len__(self):
+        return len(self._fin_nombres)
+
+    # Se lee como el diccionario clave -> archivos de los grupos con duplicados
+    def items(self):
+        return ((grupo.clave, grupo) for grupo in self.grupos.values())
+
+    def keys(self):
+        return (grupo.clave for grupo in self.grupos.values())
+
+    def values(self):
+        return self.grupos.values()
+
+    def grupo(self, clave):
+        return self.grupos.get(_clave_interna(clave))
+
+    def __getitem__(self, clave):
+        return self.grupos[_clave_interna(clave)]
+
+    def __contains__(self, clave):
+        return _clave_interna(clave) in self.grupos
@@ -0,0 +1,399 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import threading
+import time
+from core.archivos import EXTENSIONES_VALIDAS, HILOS_RECORRIDO, iterar_archivos, normalizar_raices, registro_de_ruta
+from core.duplicados import (BACKEND_HILOS, EVENTO_ARCHIVO_QUITADO, EVENTO_ERROR, EVENTO_GRUPO_CRECIO, EVENTO_GRUPO_NUEVO,
+                             EVENTO_HASHEADO, EVENTO_VIGILANDO, MAX_ARCHIVOS, Evento, hashear_con_cache, iter_duplicados)
+from core.hashing import ALGORITMO, TAMAÑO_BLOQUE, cargar_cache, guardar_cache, muestra_es_completa
+
+INTERVALO_SONDEO = 30.0  # segundos entre revisiones completas cuando no hay inotify
+# Los cambios se procesan cuando pasa ESPERA_CAMBIOS sin eventos nuevos (un archivo que se está
+# copiando genera muchos), o a lo sumo cada ESPERA_MAXIMA aunque sigan llegando
+ESPERA_CAMBIOS = 1.0
+ESPERA_MAXIMA = 10.0
+TAMAÑO_LECTURA = 64 * 1024
+
+MECANISMO_INOTIFY = "inotify"
+MECANISMO_SONDEO = "sondeo"
+
+# inotify se usa directo desde la libc con ctypes; fuera de Linux no está y se revisa por sondeo
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    _libc.inotify_init1.argtypes = [ctypes.c_int]
+    _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    _libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+except (OSError, AttributeError):
+    _libc = None
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+# IN_MODIFY no: un archivo a medio escribir se revisa recién con IN_CLOSE_WRITE
+MASCARA = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+           | IN_ONLYDIR)
+CABECERA = struct.Struct("iIII")  # wd, mask, cookie, len
+
+def _dentro(ruta, carpeta):
+    # Como esta_dentro, pero para rutas ya absolutas y sin tocar el disco
+    return ruta.startswith(carpeta.rstrip(os.sep) + os.sep)
+
+def _sin_anidadas(rutas):
+    # Revisar una carpeta ya cubre todo lo que tiene adentro
+    resultado = []
+    for ruta in sorted(rutas):
+        if not resultado or not (ruta == resultado[-1] or _dentro(ruta, resultado[-1])):
+            resultado.append(ruta)
+    return resultado
+
+class ObservadorInotify:
+    # Un watch por carpeta (inotify no es recursivo). cambios() devuelve las rutas tocadas;
+    # las carpetas nuevas se vigilan en cuanto aparecen, antes de que el índice las recorra
+    mecanismo = MECANISMO_INOTIFY
+
+    def __init__(self, raices):
+        if _libc is None:
+            raise OSError(errno.ENOSYS, "inotify no disponible")
+        self.fd = _libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        self.carpetas = {}  # wd -> ruta
+        try:
+            for raiz in raices:
+                self.agregar(raiz)
+        except OSError:
+            self.cerrar()
+            raise
+
+    def agregar(self, carpeta):
+        pendientes = [carpeta]
+        while pendientes:
+            ruta = pendientes.pop()
+            wd = _libc.inotify_add_watch(self.fd, os.fsencode(ruta), MASCARA)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error == errno.ENOSPC:
+                    raise OSError(error, "Se alcanzó el límite fs.inotify.max_user_watches")
+                continue  # la carpeta ya no está o no se puede leer
+            self.carpetas[wd] = ruta
+            try:
+                with os.scandir(ruta) as entradas:
+                    pendientes.extend(entrada.path for entrada in entradas if entrada.is_dir(follow_symlinks=False))
+            except OSError:
+                pass
+
+    def quitar(self, carpeta):
+        for wd, ruta in list(self.carpetas.items()):
+            if ruta == carpeta or _dentro(ruta, carpeta):
+                del self.carpetas[wd]
+                _libc.inotify_rm_watch(self.fd, wd)
+
+    def _leer(self, rutas):
+        # Devuelve True si el kernel descartó eventos: hay que revisar todo
+        try:
+            datos = os.read(self.fd, TAMAÑO_LECTURA)
+        except BlockingIOError:
+            return False
+        desbordado = False
+        posicion = 0
+        while posicion < len(datos):
+            wd, mascara, _, largo = CABECERA.unpack_from(datos, posicion)
+            inicio = posicion + CABECERA.size
+            nombre = datos[inicio:inicio + largo].rstrip(b"\0")
+            posicion = inicio + largo
+            if mascara & IN_Q_OVERFLOW:
+                desbordado = True
+                continue
+            carpeta = self.carpetas.get(wd)
+            if carpeta is None:
+                continue
+            if mascara & IN_IGNORED:
+                del self.carpetas[wd]
+                continue
+            if mascara & IN_DELETE_SELF:
+                rutas.add(carpeta)
+                continue
+            ruta = os.path.join(carpeta, os.fsdecode(nombre)) if nombre else carpeta
+            if mascara & IN_ISDIR:
+                if mascara & IN_ATTRIB:
+                    continue
+                if mascara & (IN_CREATE | IN_MOVED_TO):
+                    self.agregar(ruta)
+                elif mascara & IN_MOVED_FROM:
+                    self.quitar(ruta)
+            rutas.add(ruta)
+        return desbordado
+
+    def cambios(self, detener):
+        # Espera hasta que haya cambios y se calmen; devuelve (rutas, revisar_todo)
+        rutas = set()
+        desbordado = False
+        primero = ultimo = None
+        while not detener.is_set():
+            listo, _, _ = select.select([self.fd], [], [], 0.2)
+            ahora = time.monotonic()
+            if listo:
+                desbordado |= self._leer(rutas)
+                if rutas or desbordado:
+                    ultimo = ahora
+                    primero = primero or ahora
+            if primero and (ahora - ultimo >= ESPERA_CAMBIOS or ahora - primero >= ESPERA_MAXIMA):
+                break
+        return rutas, desbordado
+
+    def cerrar(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+class ObservadorSondeo:
+    # Sin inotify (otro sistema, o se agotaron los watches) cada intervalo se revisan las raíces
+    # enteras: el índice compara tamaño, mtime e inodo de cada archivo y solo rehashea lo que cambió
+    mecanismo = MECANISMO_SONDEO
+
+    def __init__(self, raices, intervalo=INTERVALO_SONDEO):
+        self.raices = raices
+        self.intervalo = intervalo
+
+    def cambios(self, detener):
+        detener.wait(self.intervalo)
+        return set(self.raices), False
+
+    def cerrar(self):
+        pass
+
+def _crear_observador(raices, usar_inotify, intervalo_sondeo):
+    if usar_inotify and _libc is not None:
+        try:
+            return ObservadorInotify(raices)
+        except OSError as e:
+            print(f"No se pudo vigilar con inotify, se revisa por sondeo: {e}")
+    return ObservadorSondeo(raices, intervalo_sondeo)
+
+class IndiceVivo:
+    # El mismo índice que arma el escaneo (tamaño -> huella parcial -> hash completo), pero que
+    # se puede actualizar archivo por archivo. Un archivo solo se lee cuando aparece otro del
+    # mismo tamaño, y los hashes pasan por el caché como en el escaneo
+    def __init__(self, raices, cache, tamaño_bloque=TAMAÑO_BLOQUE, algoritmo=ALGORITMO,
+                 extensiones=EXTENSIONES_VALIDAS):
+        self.raices = raices
+        self.cache = cache
+        self.tamaño_bloque = tamaño_bloque
+        self.algoritmo = algoritmo
+        self.extensiones = extensiones
+        self.archivos = {}
+        self.por_carpeta = {}
+        # Enlaces duros: solo el primer nombre de cada inodo entra al índice por tamaño
+        self.identidades = {}
+        self.por_tamaño = {}
+        self.parciales = {}
+        self.claves = {}
+        self.grupos = {}  # clave -> {ruta: Archivo}
+        self.bytes_leidos = 0
+
+    def cargar(self, archivos, claves):
+        # Estado inicial desde el escaneo: todos los archivos recorridos y las claves ya calculadas
+        for archivo in archivos:
+            if self._registrar(archivo):
+                self.por_tamaño.setdefault(archivo.tamaño, set()).add(archivo.ruta)
+                clave = claves.get(archivo.ruta)
+                if clave:
+                    self.claves[archivo.ruta] = clave
+                    self.grupos.setdefault(clave, {})[archivo.ruta] = archivo
+
+    def _raiz(self, ruta):
+        # Índice de la raíz más interna que contiene ruta, como en iterar_raices
+        elegida, largo = 0, -1
+        for i, raiz in enumerate(self.raices):
+            if (ruta == raiz or _dentro(ruta, raiz)) and len(raiz) > largo:
+                elegida, largo = i, len(raiz)
+        return elegida
+
+    def _debajo(self, carpeta):
+        return [ruta for otra, rutas in self.por_carpeta.items() if otra == carpeta or _dentro(otra, carpeta)
+                for ruta in rutas]
+
+    def reconciliar(self, ruta):
+        # Pone el índice al día con lo que hay ahora en ruta (archivo o carpeta, exista o no)
+        if os.path.isdir(ruta) and not os.path.islink(ruta):
+            presentes = {archivo.ruta: archivo for archivo in iterar_archivos(ruta, self.extensiones)}
+            viejas = self._debajo(ruta)
+        else:
+            archivo = registro_de_ruta(ruta, self.extensiones)
+            presentes = {ruta: archivo} if archivo else {}
+            viejas = [ruta] if archivo or ruta in self.archivos else self._debajo(ruta)
+        for vieja in viejas:
+            if vieja not in presentes:
+                yield from self._quitar(vieja)
+        for archivo in presentes.values():
+            yield from self._actualizar(archivo._replace(raiz=self._raiz(archivo.ruta)))
+
+    def _actualizar(self, archivo):
+        anterior = self.archivos.get(archivo.ruta)
+        if anterior is not None:
+            if anterior[1:5] == archivo[1:5]:  # mismo tamaño, mtime, inodo y dispositivo
+                return
+            yield from self._quitar(archivo.ruta)
+        if self._registrar(archivo):
+            yield from self._indexar(archivo)
+
+    def _registrar(self, archivo):
+        # Devuelve False si es otro nombre de un inodo que ya está en el índice
+        self.archivos[archivo.ruta] = archivo
+        self.por_carpeta.setdefault(os.path.dirname(archivo.ruta), set()).add(archivo.ruta)
+        if not archivo.inodo:
+            return True
+        nombres = self.identidades.setdefault((archivo.dispositivo, archivo.inodo), [])
+        nombres.append(archivo.ruta)
+        return len(nombres) == 1
+
+    def _quitar(self, ruta):
+        archivo = self.archivos.pop(ruta, None)
+        if archivo is None:
+            return
+        carpeta = self.por_carpeta[os.path.dirname(ruta)]
+        carpeta.discard(ruta)
+        if not carpeta:
+            del self.por_carpeta[os.path.dirname(ruta)]
+        sucesor = None
+        if archivo.inodo:
+            identidad = (archivo.dispositivo, archivo.inodo)
+            nombres = self.identidades[identidad]
+            indexado = nombres[0] == ruta
+            nombres.remove(ruta)
+            if not nombres:
+                del self.identidades[identidad]
+            if not indexado:
+                return
+            sucesor = nombres[0] if nombres else None
+        yield from self._desindexar(archivo)
+        # Si quedaba otro enlace al mismo inodo, ahora lo representa ese
+        if sucesor:
+            yield from self._indexar(self.archivos[sucesor])
+
+    def _desindexar(self, archivo):
+        mismos = self.por_tamaño[archivo.tamaño]
+        mismos.discard(archivo.ruta)
+        if not mismos:
+            del self.por_tamaño[archivo.tamaño]
+        self.parciales.pop(archivo.ruta, None)
+        clave = self.claves.pop(archivo.ruta, None)
+        if clave is None:
+            return
+        grupo = self.grupos[clave]
+        del grupo[archivo.ruta]
+        if not grupo:
+            del self.grupos[clave]
+            return
+        yield Evento(EVENTO_ARCHIVO_QUITADO, archivo, clave, list(grupo.values()))
+
+    def _hash(self, archivo, columna):
+        valor, leidos = hashear_con_cache(self.cache, archivo, columna, self.tamaño_bloque, self.algoritmo)
+        self.bytes_leidos += leidos
+        return valor
+
+    def _parcial(self, ruta):
+        if ruta not in self.parciales:
+            self.parciales[ruta] = self._hash(self.archivos[ruta], "parcial")
+        return self.parciales[ruta]
+
+    def _indexar(self, archivo):
+        mismos = self.por_tamaño.setdefault(archivo.tamaño, set())
+        mismos.add(archivo.ruta)
+        if len(mismos) < 2:
+            return
+        parcial = self._parcial(archivo.ruta)
+        if parcial is None:
+            yield Evento(EVENTO_ERROR, archivo)
+            return
+        iguales = [otra for otra in mismos if otra != archivo.ruta and self._parcial(otra) == parcial]
+        if not iguales:
+            return
+        # El archivo nuevo va último, así el evento del grupo lo trae como el que se sumó
+        for ruta in iguales + [archivo.ruta]:
+            if ruta in self.claves:
+                continue
+            actual = self.archivos[ruta]
+            clave = parcial if muestra_es_completa(actual.tamaño) else self._hash(actual, "hash")
+            if clave is None:
+                if ruta == archivo.ruta:
+                    yield Evento(EVENTO_ERROR, archivo)
+                continue
+            self.claves[ruta] = clave
+            grupo = self.grupos.setdefault(clave, {})
+            grupo[ruta] = actual
+            if len(grupo) == 2:
+                yield Evento(EVENTO_GRUPO_NUEVO, actual, clave, list(grupo.values()))
+            elif len(grupo) > 2:
+                yield Evento(EVENTO_GRUPO_CRECIO, actual, clave, list(grupo.values()))
+
+def vigilar_duplicados(carpeta, max_hilos=None, max_archivos=MAX_ARCHIVOS, hilos_recorrido=HILOS_RECORRIDO,
+                       cache_path=None, tamaño_bloque=TAMAÑO_BLOQUE, algoritmo=ALGORITMO,
+                       intervalo_sondeo=INTERVALO_SONDEO, usar_inotify=True, detener=None, backend=BACKEND_HILOS):
+    # Escaneo inicial con iter_duplicados (sus eventos salen tal cual), un EVENTO_VIGILANDO y después,
+    # hasta cerrar el generador o poner `detener`, los cambios en las raíces como GRUPO_NUEVO,
+    # GRUPO_CRECIO y ARCHIVO_QUITADO sobre los mismos grupos. Un archivo modificado sale de su
+    # grupo y vuelve a entrar con su clave nueva. Siempre en modo hash: las claves son digests
+    raices = normalizar_raices([carpeta] if isinstance(carpeta, str) else carpeta)
+    detener = detener or threading.Event()
+    # El observador se arma antes del escaneo para no perder lo que cambie mientras tanto
+    observador = _crear_observador(raices, usar_inotify, intervalo_sondeo)
+    eventos = None
+    cache = None
+    try:
+        recorridos = []
+        claves = {}
+        # Sin instantánea de carpetas: el índice guarda el stat de todos los archivos (no solo de los
+        # candidatos, que el escaneo vuelve a consultar) y lo compara con cada cambio
+        eventos = iter_duplicados(raices, max_hilos, max_archivos, hilos_recorrido=hilos_recorrido,
+                                  cache_path=cache_path, backend=backend, tamaño_bloque=tamaño_bloque,
+                                  algoritmo=algoritmo, reusar_carpetas=False, al_recorrer=recorridos.append)
+        for evento in eventos:
+            if detener.is_set():
+                return
+            if evento.tipo == EVENTO_HASHEADO and evento.clave:
+                claves[evento.archivo.ruta] = evento.clave
+            yield evento
+
+        cache = cargar_cache(cache_path, algoritmo)
+        indice = IndiceVivo(raices, cache, tamaño_bloque, algoritmo)
+        indice.cargar(recorridos, claves)
+        del recorridos, claves
+        yield Evento(EVENTO_VIGILANDO, datos={"mecanismo": observador.mecanismo, "archivos": len(indice.archivos)})
+
+        while not detener.is_set():
+            try:
+                rutas, revisar_todo = observador.cambios(detener)
+            except OSError as e:
+                print(f"Error al vigilar con inotify, se revisa por sondeo: {e}")
+                observador.cerrar()
+                observador = ObservadorSondeo(raices, intervalo_sondeo)
+                rutas, revisar_todo = (), True
+                yield Evento(EVENTO_VIGILANDO, datos={"mecanismo": observador.mecanismo, "archivos": len(indice.archivos)})
+            for ruta in (raices if revisar_todo else _sin_anidadas(rutas)):
+                yield from indice.reconciliar(ruta)
+            guardar_cache(cache)
+    finally:
+        if eventos is not None:
+            eventos.close()
+        observador.cerrar()
+        if cache is not None:
+            guardar_cache(cache)
+            cache.cerrar()
+
+def vigilar(carpeta, callback, detener=None, **opciones):
+    # Lo mismo con un callback: callback(evento) por cada evento, hasta que se ponga `detener`
+    for evento in vigilar_duplicados(carpeta, detener=detener, **opciones):
+        callback(evento)
@@ -1,10 +1,11 @@
 import os
 import threading
+import time
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 from PIL import Image, ImageTk
 
-from core import duplicados, archivos, imagenes
+from core import duplicados, archivos, imagenes, resultados, vigilancia
 from utils import sistema
 
 class VentanaDuplicados:
@@ -14,9 +15,16 @@ class VentanaDuplicados:
         self.ventana.geometry("1000x660")
 
         self.duplicados_global = {}
+        self.resultados = resultados.AlmacenResultados()
+        self.cerrando = threading.Event()
+        self.hilo_busqueda = None
+        self.detener_busqueda = threading.Event()
+        # Con "Buscar en varias carpetas" la entrada muestra solo la primera; la lista va acá
+        self.raices_actuales = None
 
         self._crear_widgets()
         self._configurar_eventos()
+        self.ventana.protocol("WM_DELETE_WINDOW", self.cerrar)
 
     def _crear_widgets(self):
         frame = ttk.Frame(self.ventana, padding=10)
@@ -28,6 +36,14 @@ class VentanaDuplicados:
         self.boton_explorar = ttk.Button(frame, text="Seleccionar carpeta", command=self.seleccionar_carpeta)
         self.boton_explorar.grid(row=0, column=1, padx=5)
 
+        self.boton_varias = ttk.Button(frame, text="Buscar en varias carpetas", command=self.seleccionar_varias_carpetas)
+        self.boton_varias.grid(row=0, column=2, padx=5)
+
+        # Después del escaneo sigue los cambios de la carpeta y actualiza la tabla sola
+        self.vigilar = tk.BooleanVar(value=False)
+        self.check_vigilar = ttk.Checkbutton(frame, text="Vigilar cambios", variable=self.vigilar)
+        self.check_vigilar.grid(row=0, column=3, padx=5)
+
         self.progress_bar = ttk.Progressbar(self.ventana, mode='determinate')
         self.progress_bar.pack(fill='x', padx=10, pady=5)
 
@@ -70,17 +86,20 @@ class VentanaDuplicados:
         self.boton_eliminar_auto = ttk.Button(frame_botones, text="Eliminar duplicados automáticamente", command=self.eliminar_duplicados_automatico)
         self.boton_eliminar_auto.grid(row=0, column=0, padx=10)
 
+        self.boton_enlazar = ttk.Button(frame_botones, text="Reemplazar duplicados por enlaces", command=self.enlazar_duplicados)
+        self.boton_enlazar.grid(row=0, column=1, padx=10)
+
         self.boton_comparar = ttk.Button(frame_botones, text="Eliminar duplicados entre carpetas", command=self.comparar_y_eliminar_entre_carpetas)
-        self.boton_comparar.grid(row=0, column=4, padx=10)
+        self.boton_comparar.grid(row=0, column=5, padx=10)
 
         self.boton_mover = ttk.Button(frame_botones, text="Mover duplicados a carpeta 'archivos a borrar'", command=self.mover_duplicados_a_carpeta)
-        self.boton_mover.grid(row=0, column=1, padx=10)
+        self.boton_mover.grid(row=0, column=2, padx=10)
 
         self.boton_mover_imagenes = ttk.Button(frame_botones, text="Mover imágenes a 'imagenes extraidas'", command=self.mover_imagenes_a_carpeta)
-        self.boton_mover_imagenes.grid(row=0, column=2, padx=10)
+        self.boton_mover_imagenes.grid(row=0, column=3, padx=10)
 
         self.boton_refrescar = ttk.Button(frame_botones, text="Refrescar resultados", command=self.refrescar_resultados)
-        self.boton_refrescar.grid(row=0, column=3, padx=10)
+        self.boton_refrescar.grid(row=0, column=4, padx=10)
 
         frame_prefijo = ttk.Frame(self.ventana)
         frame_prefijo.pack(pady=10)
@@ -119,33 +138,24 @@ class VentanaDuplicados:
         self.contador_label.config(text="Comparando hashes entre carpetas...")
         self.ventana.update_idletasks()
 
-        from core import duplicados
-
-        hashes_a, _ = duplicados.escanear_y_hash(carpeta_a)
-        hashes_b, _ = duplicados.escanear_y_hash(carpeta_b)
-
-        # Crear sets para comparación rápida
-        hash_set_a = set(hashes_a.keys())
-        duplicados_en_b = [archivo for h, archivo in hashes_b.items() if h in hash_set_a]
+        # Solo se leen los archivos de B con un tamaño que también existe en A
+        pares, _ = duplicados.comparar_carpetas(carpeta_a, carpeta_b, progress_callback=self.actualizar_progreso)
+        duplicados_en_b = [ruta_b for ruta_b, _ in pares]
 
-        # Filtrar duplicados válidos
-        duplicados_validos = [d for d in duplicados_en_b if isinstance(d, list) and len(d) > 1]
-
-        if not duplicados_validos:
+        if not duplicados_en_b:
             messagebox.showinfo("Resultado", "No se encontraron duplicados entre las carpetas.")
             return
 
-        # Si hay duplicados válidos, armar el resumen
         resumen = "\n".join([
-            os.path.basename(r[0]) for r in duplicados_validos[:10] if r and isinstance(r, list) and isinstance(r[0], str)
+            f"{os.path.basename(ruta_b)}  =  {ruta_a}" for ruta_b, ruta_a in pares[:10]
         ])
 
-        if len(duplicados_validos) > 10:
-            resumen += f"\n...y {len(duplicados_validos) - 10} más"
+        if len(pares) > 10:
+            resumen += f"\n...y {len(pares) - 10} más"
 
         confirmar = messagebox.askyesno(
             "Confirmar eliminación",
-            f"Se eliminarán {len(duplicados_validos)} archivos duplicados de la carpeta B:\n\n{resumen}\n\n¿Continuar?"
+            f"Se eliminarán {len(duplicados_en_b)} archivos duplicados de la carpeta B:\n\n{resumen}\n\n¿Continuar?"
         )
         if not confirmar:
             return
@@ -178,7 +188,40 @@ class VentanaDuplicados:
         if carpeta:
             self.entrada_carpeta.delete(0, tk.END)
             self.entrada_carpeta.insert(0, carpeta)
-            threading.Thread(target=self.buscar_duplicados, args=(carpeta,), daemon=True).start()
+            self.raices_actuales = None
+            self._iniciar_busqueda(carpeta)
+
+    def seleccionar_varias_carpetas(self):
+        # Se piden carpetas hasta cancelar; los duplicados se buscan entre todas a la vez
+        carpetas = []
+        while carpeta := filedialog.askdirectory(title=f"Carpeta {len(carpetas) + 1} (Cancelar para terminar)"):
+            carpetas.append(carpeta)
+        if carpetas:
+            self.entrada_carpeta.delete(0, tk.END)
+            self.entrada_carpeta.insert(0, carpetas[0])
+            self.raices_actuales = carpetas
+            self._iniciar_busqueda(carpetas)
+
+    def _iniciar_busqueda(self, carpeta):
+        # Una búsqueda nueva corta la anterior (que en modo vigilancia no termina sola)
+        self.detener_busqueda.set()
+        self.detener_busqueda = threading.Event()
+        self.hilo_busqueda = threading.Thread(target=self.buscar_duplicados, args=(carpeta, self.detener_busqueda),
+                                              daemon=True)
+        self.hilo_busqueda.start()
+
+    def cerrar(self):
+        # Se corta el escaneo en curso para que guarde en el caché lo ya hasheado antes de salir;
+        # el próximo escaneo de la misma carpeta retoma desde ahí
+        self.cerrando.set()
+        self.detener_busqueda.set()
+        self._esperar_cierre(time.monotonic() + 10)
+
+    def _esperar_cierre(self, limite):
+        if self.hilo_busqueda and self.hilo_busqueda.is_alive() and time.monotonic() < limite:
+            self.ventana.after(100, self._esperar_cierre, limite)
+            return
+        self.ventana.destroy()
 
     def actualizar_progreso(self, contador, total):
         self.progress_bar["maximum"] = total
@@ -186,20 +229,84 @@ class VentanaDuplicados:
         self.contador_label.config(text=f"Archivos escaneados: {contador}/{total}")
         self.ventana.update_idletasks()
 
-    def buscar_duplicados(self, carpeta):
+    def buscar_duplicados(self, carpeta, detener=None):
+        detener = detener or self.cerrando
         self.tabla.delete(*self.tabla.get_children())
-        hashes, errores = duplicados.escanear_y_hash(carpeta, progress_callback=self.actualizar_progreso)
-        self.duplicados_global = duplicados.filtrar_duplicados(hashes)
-
-        for grupo_hash, lista_archivos in self.duplicados_global.items():
-            self.tabla.insert("", tk.END, values=(f"Grupo ({len(lista_archivos)} duplicados)", "", "", ""), tags=('grupo',))
-            for archivo in lista_archivos:
-                try:
-                    tamaño = os.path.getsize(archivo)
-                except Exception:
-                    tamaño = 0
-                tipo = "Imagen" if archivo.lower().endswith(archivos.EXT_IMAGENES) else "Video"
-                self.tabla.insert("", tk.END, values=(archivo, os.path.basename(archivo), f"{tamaño/1024:.1f} KB", tipo), tags=('archivo',))
+        # Los grupos se guardan en columnas compactas; duplicados_global son sus grupos (clave -> Grupo)
+        self.resultados = resultados.AlmacenResultados()
+        self.duplicados_global = self.resultados.grupos
+        filas_grupo = {}
+        texto = ""
+
+        # Los grupos se muestran a medida que aparecen, sin esperar al final del escaneo
+        if self.vigilar.get():
+            eventos = vigilancia.vigilar_duplicados(carpeta, detener=detener)
+        else:
+            eventos = duplicados.iter_duplicados(carpeta)
+        for evento in eventos:
+            if detener.is_set():
+                eventos.close()
+                return
+            if evento.tipo in (duplicados.EVENTO_HASHEADO, duplicados.EVENTO_ERROR):
+                self.actualizar_progreso(evento.contador, evento.total)
+            elif evento.tipo == duplicados.EVENTO_GRUPO_NUEVO:
+                indices = [self.resultados.agregar(archivo, evento.clave) for archivo in evento.grupo]
+                grupo = self.resultados[evento.clave]
+                fila = self.tabla.insert("", tk.END, values=(self._titulo_grupo(grupo), "", "", ""), tags=('grupo',), open=True)
+                filas_grupo[evento.clave] = fila
+                for indice in indices:
+                    self._insertar_archivo(fila, indice)
+            elif evento.tipo == duplicados.EVENTO_GRUPO_CRECIO:
+                indice = self.resultados.agregar(evento.archivo, evento.clave)
+                fila = filas_grupo[evento.clave]
+                self.tabla.item(fila, values=(self._titulo_grupo(self.resultados[evento.clave]), "", "", ""))
+                self._insertar_archivo(fila, indice)
+            elif evento.tipo == duplicados.EVENTO_ARCHIVO_QUITADO:
+                indices = self.resultados.quitar(evento.clave, evento.archivo.ruta)
+                fila = filas_grupo.get(evento.clave)
+                if fila is None:
+                    continue
+                if evento.clave not in self.resultados:
+                    # Quedó un solo archivo: el grupo sale entero de la tabla
+                    self.tabla.delete(filas_grupo.pop(evento.clave))
+                else:
+                    self.tabla.delete(*[f"archivo{indice}" for indice in indices])
+                    self.tabla.item(fila, values=(self._titulo_grupo(self.resultados[evento.clave]), "", "", ""))
+            elif evento.tipo == duplicados.EVENTO_VIGILANDO:
+                if evento.datos["mecanismo"] == vigilancia.MECANISMO_INOTIFY:
+                    texto_vigilancia = " - vigilando cambios"
+                else:
+                    texto_vigilancia = f" - revisando cambios cada {vigilancia.INTERVALO_SONDEO:.0f} s"
+                self.contador_label.config(text=texto + texto_vigilancia)
+            elif evento.tipo == duplicados.EVENTO_FIN:
+                estadisticas = evento.datos
+                texto = (f"Archivos escaneados: {estadisticas['total']} "
+                         f"(omitidos por tamaño único: {estadisticas['omitidos_tamaño_unico']}, "
+                         f"enlaces duros: {estadisticas['enlaces_omitidos']})")
+                if estadisticas["truncado"]:
+                    texto += f" - se alcanzó el límite de {duplicados.MAX_ARCHIVOS} archivos"
+                if estadisticas.get("error_recorrido"):
+                    texto += " - el recorrido falló a la mitad, los resultados pueden estar incompletos"
+                if len(estadisticas["raices"]) > 1:
+                    texto += f" - grupos entre carpetas: {estadisticas['grupos_entre_raices']}"
+                if estadisticas["reanudado"]:
+                    texto += f" - escaneo reanudado ({estadisticas['reutilizados']} hashes ya calculados)"
+                self.contador_label.config(text=texto)
+
+    def _titulo_grupo(self, grupo):
+        titulo = f"Grupo ({len(grupo)} duplicados)"
+        raices = duplicados.raices_de_grupo(grupo)
+        if len(raices) > 1:
+            titulo += f" en {len(raices)} carpetas"
+        return titulo
+
+    def _insertar_archivo(self, fila_grupo, indice):
+        # La fila se identifica con el índice del archivo en self.resultados
+        nombre = self.resultados.nombre(indice)
+        tipo = "Imagen" if nombre.lower().endswith(archivos.EXT_IMAGENES) else "Video"
+        self.tabla.insert(fila_grupo, tk.END, iid=f"archivo{indice}",
+                          values=(self.resultados.ruta(indice), nombre, f"{self.resultados.tamaños[indice]/1024:.1f} KB", tipo),
+                          tags=('archivo',))
 
     def abrir_archivo(self, event):
         item = self.tabla.identify_row(event.y)
@@ -221,7 +328,11 @@ class VentanaDuplicados:
             return
 
         try:
-            tamaño_bytes = os.path.getsize(ruta)
+            fila = seleccion[0]
+            if fila.startswith("archivo"):
+                tamaño_bytes = self.resultados.tamaños[int(fila[len("archivo"):])]
+            else:
+                tamaño_bytes = os.path.getsize(ruta)
 
             if ruta.lower().endswith(archivos.EXT_IMAGENES):
                 if tamaño_bytes > 20 * 1024 * 1024:
@@ -259,7 +370,7 @@ class VentanaDuplicados:
 
         archivos_a_eliminar = []
         for grupo in self.duplicados_global.values():
-            archivos_a_eliminar.extend(grupo[1:])  # dejar el primero
+            archivos_a_eliminar.extend(archivo.ruta for archivo in grupo[1:])  # dejar el primero
 
         if not archivos_a_eliminar:
             messagebox.showinfo("Nada que eliminar", "No hay duplicados para eliminar.")
@@ -301,6 +412,60 @@ class VentanaDuplicados:
 
         threading.Thread(target=eliminar_tarea, daemon=True).start()
 
+    def enlazar_duplicados(self):
+        if not self.duplicados_global:
+            messagebox.showinfo("Info", "No hay duplicados cargados.")
+            return
+
+        # Un enlace no cruza dispositivos: en cada grupo se conserva un archivo por dispositivo,
+        # el que ya tenga más enlaces duros, para no separarlo de los nombres que comparte
+        pares = []
+        for grupo in self.duplicados_global.values():
+            originales = {}
+            for archivo in sorted(grupo, key=lambda archivo: -archivo.enlaces):
+                original = originales.setdefault(archivo.dispositivo, archivo)
+                if original is not archivo:
+                    pares.append((original, archivo))
+
+        if not pares:
+            messagebox.showinfo("Nada que enlazar", "No hay duplicados en un mismo disco para enlazar.")
+            return
+
+        resumen = "\n".join([os.path.basename(archivo.ruta) for _, archivo in pares[:10]])
+        if len(pares) > 10:
+            resumen += f"\n...y {len(pares) - 10} más"
+
+        confirmar = messagebox.askyesno("Reemplazar duplicados por enlaces",
+            f"Se reemplazarán {len(pares)} archivos por reflinks (o enlaces duros si el disco no los soporta), "
+            f"conservando las carpetas tal como están.\n\nEjemplos:\n{resumen}\n\n¿Continuar?")
+
+        if not confirmar:
+            return
+
+        self.progress_bar["maximum"] = len(pares)
+        self.progress_bar["value"] = 0
+        self.ventana.update_idletasks()
+
+        errores = []
+
+        def enlazar_tarea():
+            for i, (original, archivo) in enumerate(pares, 1):
+                error = sistema.enlazar_archivo(original.ruta, archivo.ruta, archivo.mtime_ns,
+                                                mtime_original_ns=original.mtime_ns)
+                if error:
+                    errores.append(error)
+                self.progress_bar["value"] = i
+                self.ventana.update_idletasks()
+
+            if errores:
+                messagebox.showwarning("Errores", f"No se pudieron enlazar {len(errores)} archivos:\n" + "\n".join(errores[:10]))
+            else:
+                messagebox.showinfo("Hecho", f"Se reemplazaron {len(pares)} duplicados por enlaces.")
+
+            self.seleccionar_carpeta()
+
+        threading.Thread(target=enlazar_tarea, daemon=True).start()
+
     def mover_duplicados_a_carpeta(self):
         if not self.duplicados_global:
             messagebox.showinfo("Info", "No hay duplicados cargados.")
@@ -312,7 +477,7 @@ class VentanaDuplicados:
 
         archivos_a_mover = []
         for grupo in self.duplicados_global.values():
-            archivos_a_mover.extend(grupo[1:])  # dejar el primero
+            archivos_a_mover.extend(archivo.ruta for archivo in grupo[1:])  # dejar el primero
 
         if not archivos_a_mover:
             messagebox.showinfo("Nada que mover", "No hay duplicados para mover.")
@@ -362,7 +527,7 @@ class VentanaDuplicados:
         carpeta_destino = os.path.join(carpeta_raiz, "imagenes extraidas")
         os.makedirs(carpeta_destino, exist_ok=True)
 
-        imagenes = archivos.encontrar_archivos(carpeta_raiz, archivos.EXT_IMAGENES)
+        imagenes = [archivo.ruta for archivo in archivos.iterar_archivos(carpeta_raiz, archivos.EXT_IMAGENES)]
 
         if not imagenes:
             messagebox.showinfo("Sin imágenes", "No se encontraron imágenes para mover.")
@@ -415,8 +580,10 @@ class VentanaDuplicados:
             messagebox.showwarning("Error", "Escribe un prefijo para buscar.")
             return
 
-        imagenes = archivos.encontrar_archivos(carpeta, archivos.EXT_IMAGENES)
-        candidatas = [ruta for ruta in imagenes if os.path.basename(ruta).startswith(prefijo)]
+        candidatas = [
+            archivo.ruta for archivo in archivos.iterar_archivos(carpeta, archivos.EXT_IMAGENES)
+            if os.path.basename(archivo.ruta).startswith(prefijo)
+        ]
 
         if not candidatas:
             messagebox.showinfo("Sin coincidencias", f"No se encontraron imágenes que empiecen con '{prefijo}'.")
@@ -458,8 +625,10 @@ class VentanaDuplicados:
 
     def refrescar_resultados(self):
         carpeta = self.entrada_carpeta.get()
-        if carpeta and os.path.isdir(carpeta):
-            threading.Thread(target=self.buscar_duplicados, args=(carpeta,), daemon=True).start()
+        if self.raices_actuales and carpeta == self.raices_actuales[0]:
+            self._iniciar_busqueda(self.raices_actuales)
+        elif carpeta and os.path.isdir(carpeta):
+            self._iniciar_busqueda(carpeta)
 
 def iniciar_ventana():
     app = VentanaDuplicados()
@@ -1,4 +1,12 @@
 import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+FICLONE = 0x40049409  # ioctl de Linux para clonar un archivo compartiendo bloques (btrfs, XFS)
 
 def eliminar_archivo(ruta):
     try:
@@ -24,3 +32,45 @@ def mover_archivo(origen, destino):
         return None
     except Exception as e:
         return f"Error moviendo {origen} a {destino}: {e}"
+
+def _clonar(origen, destino):
+    with open(origen, "rb") as fo, open(destino, "wb") as fd:
+        fcntl.ioctl(fd.fileno(), FICLONE, fo.fileno())
+
+def enlazar_archivo(original, duplicado, mtime_ns=None, reflink=True, mtime_original_ns=None):
+    # Reemplaza duplicado por un reflink (copia que comparte bloques) o, si el sistema de
+    # archivos no lo soporta, por un enlace duro a original. Se arma aparte y se renombra
+    # encima, así un fallo a mitad de camino nunca deja el duplicado truncado.
+    # mtime_ns y mtime_original_ns son los del escaneo: si alguno de los dos cambió, su
+    # contenido ya no es el que se comparó y no se toca nada
+    temporal = os.path.join(os.path.dirname(duplicado), f".{os.path.basename(duplicado)}.enlace-{os.getpid()}")
+    try:
+        stat_original = os.stat(original)
+        stat_duplicado = os.stat(duplicado)
+        if (stat_original.st_dev, stat_original.st_ino) == (stat_duplicado.st_dev, stat_duplicado.st_ino):
+            return None
+        if stat_original.st_size != stat_duplicado.st_size or (
+                mtime_ns is not None and stat_duplicado.st_mtime_ns != mtime_ns):
+            return f"Archivo modificado desde el escaneo: {duplicado}"
+        if mtime_original_ns is not None and stat_original.st_mtime_ns != mtime_original_ns:
+            return f"Archivo modificado desde el escaneo: {original}"
+        if stat_original.st_dev != stat_duplicado.st_dev:
+            return f"No se puede enlazar entre dispositivos distintos: {duplicado}"
+
+        clonado = False
+        if reflink and fcntl:
+            try:
+                _clonar(original, temporal)
+                shutil.copystat(duplicado, temporal)
+                clonado = True
+            except OSError:
+                if os.path.exists(temporal):
+                    os.remove(temporal)
+        if not clonado:
+            os.link(original, temporal)
+        os.replace(temporal, duplicado)
+        return None
+    except Exception as e:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+        return f"Error enlazando {duplicado} a {original}: {e}"